@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+'''Benchmark of the LIRK implementations for numpy arrays.
+
+Compares the callback implementation (LIRK.step, LIRKStepper) with the
+compiled StagePlan on a 1d heat equation of increasing size. The
+factorization of the system matrix is cached in all variants, so the
+timings only differ by the overhead of the stage loops and callbacks.
+
+The EnsemblePlan is compared with integrating the members of an ensemble of
+scalar equations one by one (extrapolated from a single member).'''
+
+import sys
+from timeit import default_timer as timer
+import numpy as np
+import scipy.sparse
+from scipy.sparse.linalg import splu
+from lirk import *
+
+
+def heat_1d(n):
+	'''Finite difference discretization of u_t = u_xx + sin(pi x)cos(t)'''
+	h = 1./(n+1)
+	J = scipy.sparse.diags([np.ones(n-1),-2*np.ones(n),np.ones(n-1)],[-1,0,1],format='csc')/h**2
+	x = np.linspace(h,1-h,n)
+	s = np.sin(np.pi*x)
+	u0 = np.sin(2*np.pi*x)
+	return J, s, u0
+
+
+def bench_callbacks(scheme,n,num_steps,dt,stepper=False):
+	J, src, u0 = heat_1d(n)
+	lu = splu(scipy.sparse.identity(n,format='csc')/(dt*scheme.gamma_diag) - J)
+
+	def sys(v,fac,t,rhs,fac2):
+		v[:] += fac*lu.solve(rhs)
+	def F(v,fac,t,u):
+		v[:] += fac*(J.dot(u) + src*np.cos(t))
+	def dtF(v,fac,t,u):
+		v[:] -= fac*src*np.sin(t)
+	def M(v,fac,t,u):
+		v[:] += fac*u[:]
+	def vecsrc(k):
+		return [np.zeros(n) for i in range(k)]
+	def veccpy(u,v):
+		v[:] = u[:]
+	def zero(u):
+		u[:] = 0
+	def axpy(x,a,y):
+		x += a*y
+
+	u = u0.copy()
+	t = 0.
+	start = timer()
+	if stepper:
+		st = LIRKStepper(scheme,vecsrc,veccpy,zero,axpy)
+		for k in range(num_steps):
+			st.step(sys,F,dtF,M,t,dt,u)
+			t += dt
+	else:
+		for k in range(num_steps):
+			scheme.step(sys,F,dtF,M,t,dt,u,vecsrc,veccpy,zero,axpy)
+			t += dt
+	return timer()-start, u
+
+
+def bench_plan(scheme,n,num_steps,dt):
+	J, src, u0 = heat_1d(n)
+	plan = scheme.compile(n,J=J)
+	F = lambda t,u: J.dot(u) + src*np.cos(t)
+	dtF = lambda t,u: -src*np.sin(t)
+
+	u = u0.copy()
+	t = 0.
+	plan.factorize(dt)
+	start = timer()
+	for k in range(num_steps):
+		plan.step(F,t,dt,u,dtF)
+		t += dt
+	return timer()-start, u
+
+
+def bench_ensemble(scheme,N,num_steps,dt):
+	'''N scalar test equations u' = lambda u + sin(t), as one ensemble and one by one'''
+	lmbdas = -np.linspace(.1,2,N)
+	plan = scheme.compile_ensemble(N,1,lmbdas[:,None,None])
+	F = lambda t,u: lmbdas[:,None]*u + np.sin(t)[:,None]
+	dtF = lambda t,u: np.cos(t)[:,None]*np.ones_like(u)
+
+	u = np.ones((N,1))
+	t = np.zeros(N)
+	start = timer()
+	for k in range(num_steps):
+		plan.step(F,t,dt,u,dtF)
+		t += dt
+	t_ens = timer()-start
+
+	# one member with the scalar stage plan for comparison
+	plan1 = scheme.compile(1,J=np.array([[lmbdas[0]]]))
+	u1 = np.ones(1)
+	start = timer()
+	for k in range(num_steps):
+		plan1.step(lambda t,u: lmbdas[0]*u + np.sin(t),k*dt,dt,u1,lambda t,u: np.cos(t))
+	t_one = timer()-start
+	assert np.allclose(u[0],u1)
+	return t_ens, t_one
+
+
+def main(sizes=(1,10,100,1000,10000),num_steps=200,dt=1e-3):
+	print('{:>10} {:>6} {:>12} {:>12} {:>12} {:>8}'.format(
+		'scheme','n','step [ms]','stepper [ms]','plan [ms]','speedup'))
+	for scheme in (ros3pw,ros34pw2):
+		for n in sizes:
+			t_cb, u_cb = bench_callbacks(scheme,n,num_steps,dt)
+			t_st, u_st = bench_callbacks(scheme,n,num_steps,dt,stepper=True)
+			t_pl, u_pl = bench_plan(scheme,n,num_steps,dt)
+			assert np.allclose(u_cb,u_pl) and np.allclose(u_cb,u_st)
+			print('{:>10} {:>6} {:>12.4f} {:>12.4f} {:>12.4f} {:>8.2f}'.format(
+				scheme.name,n,1e3*t_cb/num_steps,1e3*t_st/num_steps,1e3*t_pl/num_steps,t_cb/t_pl))
+
+	print('')
+	print('{:>10} {:>6} {:>14} {:>16}'.format('scheme','N','ensemble [ms]','one by one [ms]'))
+	for scheme in (ros3pw,ros34pw2):
+		for N in (100,1000,10000):
+			t_ens, t_one = bench_ensemble(scheme,N,num_steps,dt)
+			print('{:>10} {:>6} {:>14.4f} {:>16.4f}'.format(
+				scheme.name,N,1e3*t_ens/num_steps,1e3*N*t_one/num_steps))
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		main(sizes=[int(n) for n in sys.argv[1:]])
+	else:
+		main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''Benchmark suite for solve_stokes.
+
+Runs a fixed number of time steps of solve_stokes for several problems
+(lid driven cavity on refined UnitSquareMeshes, the Karman meshes if they
+have been generated) with each linear solver (krypy, minres, petsc, lu)
+and, for krypy, with and without deflation. Every configuration runs in
+its own process, so the peak memory is measured per configuration.
+
+The wall time per phase (see SolveStats), the GMRES iterations, the peak
+RSS and the DOFs/sec are written to a JSON file. If a baseline file of an
+earlier run is given, the results are compared with it and the exit code
+is nonzero if a configuration got slower (or needs more iterations) than
+the tolerance allows.
+
+  $ python bench_stokes.py --output bench.json
+  $ python bench_stokes.py --baseline bench.json --tolerance 0.1
+'''
+
+import os
+import sys
+import json
+import argparse
+import resource
+import multiprocessing
+from timeit import default_timer as timer
+
+
+def cavity_problem(refine):
+    '''lid driven cavity on a UnitSquareMesh with 2**refine cells per direction'''
+    from dolfin import UnitSquareMesh, MeshFunction, SubDomain, Constant, DOLFIN_EPS
+    n = 2**refine
+    mesh = UnitSquareMesh(n, n)
+    boundaries = MeshFunction('size_t', mesh, mesh.topology().dim()-1)
+    boundaries.set_all(0)
+
+    class Walls(SubDomain):
+        def inside(self, x, on_boundary):
+            return on_boundary
+    Walls().mark(boundaries, 1)
+
+    class Lid(SubDomain):
+        def inside(self, x, on_boundary):
+            return on_boundary and x[1]>1-DOLFIN_EPS
+    Lid().mark(boundaries, 2)
+
+    return mesh, dict(
+            u_init = Constant((0.0,0.0)),
+            f = Constant((0.0,0.0)),
+            lagrange_mult = True,
+            boundaries = boundaries,
+            dbcs = {1: Constant((0.0,0.0)), 2: Constant((1.0,0.0))},
+            )
+
+
+def get_problem(name):
+    import stokes
+    if name.startswith('square'):
+        return cavity_problem(int(name[len('square'):]))
+    if name == 'karman2d':
+        return stokes.karman2d_problem()
+    if name == 'karman3d':
+        return stokes.karman3d_problem()
+    raise ValueError("Problem '%s' unknown." % name)
+
+
+def config_name(config):
+    return '%s/%s/defl%d' % (config['problem'], config['linsolver'], config['n_defl'])
+
+
+def run_config(config):
+    '''run solve_stokes for one configuration (in a fresh process)'''
+    from dolfin import set_log_level, WARNING
+    from stokes import solve_stokes
+    set_log_level(WARNING)
+
+    mesh, problem = get_problem(config['problem'])
+    dt = config['scale_dt']*mesh.hmax()
+    start = timer()
+    sol = solve_stokes(mesh,
+            scale_dt = config['scale_dt'],
+            tend = config['num_steps']*dt*(1-1e-10),
+            linsolver = config['linsolver'],
+            n_defl = config['n_defl'],
+            **problem
+            )
+    wall = timer() - start
+
+    # velocity (P2) and pressure (P1) dofs (and the Lagrange multiplier)
+    n_dofs = sol['u'].function_space().dim() + sol['p'].function_space().dim()
+    if problem.get('lagrange_mult'):
+        n_dofs += 1
+    iterations = [it for record in sol['stats'] for it in record['iterations']
+                  if it is not None]
+    # ru_maxrss is in kilobytes on Linux and in bytes on OS X
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+    return {
+            'name': config_name(config),
+            'config': config,
+            'n_dofs': n_dofs,
+            'wall': wall,
+            'timings': sol['timings'],
+            'iterations': sum(iterations),
+            'max_iterations': max(iterations) if iterations else 0,
+            'peak_rss': peak_rss,
+            'dofs_per_sec': n_dofs*config['num_steps']/wall,
+            }
+
+
+def configs(refines, num_steps, scale_dt, n_defl):
+    problems = ['square%d' % r for r in refines]
+    for name in ['karman2d', 'karman3d']:
+        if os.path.exists('msh_%s.xml' % name):
+            problems.append(name)
+    for problem in problems:
+        for linsolver, defl in [('krypy', 0), ('krypy', n_defl), ('minres', 0), ('petsc', 0), ('lu', 0)]:
+            yield {'problem': problem, 'linsolver': linsolver, 'n_defl': defl,
+                   'num_steps': num_steps, 'scale_dt': scale_dt}
+
+
+def compare(results, baseline, tolerance):
+    '''compare with a baseline, returns the names of the regressed configurations'''
+    base = dict((r['name'], r) for r in baseline['results'])
+    regressions = []
+    print('')
+    print('{:>28} {:>10} {:>10} {:>8} {:>8} {:>8}'.format(
+        'configuration', 'wall [s]', 'base [s]', 'ratio', 'its', 'base'))
+    for r in results:
+        b = base.get(r['name'])
+        if b is None:
+            continue
+        ratio = r['wall']/b['wall']
+        regressed = ratio > 1+tolerance or r['iterations'] > (1+tolerance)*b['iterations']
+        print('{:>28} {:>10.3f} {:>10.3f} {:>8.2f} {:>8d} {:>8d}{}'.format(
+            r['name'], r['wall'], b['wall'], ratio, r['iterations'], b['iterations'],
+            '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(r['name'])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark suite for solve_stokes.')
+    parser.add_argument('--refines', type=int, nargs='+', default=[3, 4, 5])
+    parser.add_argument('--num-steps', type=int, default=5)
+    parser.add_argument('--scale-dt', type=float, default=0.2)
+    parser.add_argument('--n-defl', type=int, default=5)
+    parser.add_argument('--output', default='bench_stokes.json')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = []
+    print('{:>28} {:>8} {:>10} {:>6} {:>10} {:>12}'.format(
+        'configuration', 'n_dofs', 'wall [s]', 'its', 'RSS [MB]', 'DOFs/sec'))
+    for config in configs(args.refines, args.num_steps, args.scale_dt, args.n_defl):
+        # a new process for each configuration to measure its peak memory
+        pool = multiprocessing.Pool(1)
+        r = pool.apply(run_config, (config,))
+        pool.close()
+        pool.join()
+        results.append(r)
+        print('{:>28} {:>8d} {:>10.3f} {:>6d} {:>10.1f} {:>12.1f}'.format(
+            r['name'], r['n_dofs'], r['wall'], r['iterations'], r['peak_rss']/2.**20,
+            r['dofs_per_sec']))
+
+    with open(args.output, 'w') as f:
+        json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+    if baseline is not None:
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,6 +7,7 @@ Date:   2012/12/08
 
 This module realizes \f$s\f$-stage Linearly Implicit Runge-Kutta (LIRK) methods.'''
 
+import warnings
 import numpy as np
 from math import sqrt
 from numpy.linalg import inv
@@ -201,6 +202,9 @@ class LIRK():
 		veccpy      -- function; veccpy(a,b) should copy the contents of vector a to b
 		zero				-- function; reset all values of a vector to 0
 		axpy        -- axpy(x,a,y) should realize the axpy function x += a*y
+
+		Returns the error estimate \f$\hat u_{n+1} - u_{n+1}\f$ of the embedded
+		method, or None if the method has no embedded method.
 		'''
 
 		# Acquire memory:
@@ -210,6 +214,13 @@ class LIRK():
 		rhs = vecsrc(1)[0]
 		# - for ui
 		ui = vecsrc(1)[0]
+		# - for the error estimate
+		err_est = vecsrc(1)[0] if self.bhat.any() else None
+
+		return self._step(sys,F,dtF,M,t,dt,u,veccpy,zero,axpy,U_ni,rhs,ui,err_est)
+
+	def _step(self,sys,F,dtF,M,t,dt,u,veccpy,zero,axpy,U_ni,rhs,ui,err_est):
+		'''Executes one LIRK step in the given workspace, see step()'''
 
 		for i in range(self.num_stages):
 			ti = t + self.alpha_i[i]*dt
@@ -226,10 +237,589 @@ class LIRK():
 
 		for i in range(self.num_stages):
 			axpy(u,self.m[i],U_ni[i])
-		# err_est = 0
-		#	if self.bhat.any():
-		#		err_est += (self.mhat[i] - self.m[i])*U_ni[i]
-		# return err_est
+
+		if err_est is not None:
+			zero(err_est)
+			for i in range(self.num_stages):
+				axpy(err_est,self.mhat[i]-self.m[i],U_ni[i])
+			return err_est
+
+	def check_embedded(self):
+		'''Raises a ValueError if the method has no usable error estimate
+
+		This is the case if there is no embedded method or if the embedded
+		method coincides with the main method (e.g. ROS2), so the error
+		estimate always vanishes.'''
+		if not self.bhat.any():
+			raise ValueError('{} has no embedded method for error estimation'.format(self.name))
+		if np.allclose(self.mhat,self.m):
+			raise ValueError('The embedded method of {} coincides with the method, the error estimate vanishes'.format(self.name))
+		if self.linear_estimate_vanishes():
+			warnings.warn('The error estimate of {} vanishes for linear autonomous problems, '
+				'the step sizes are not controlled for them'.format(self.name))
+
+	def linear_estimate_vanishes(self):
+		'''True if the error estimate vanishes for all linear autonomous problems
+
+		For \f$u' = \lambda u\f$ the method and its embedded method give
+		\f$R(\tau\lambda)u_n\f$ and \f$\hat R(\tau\lambda)u_n\f$ with the stability
+		functions \f$R(z) = 1 + z b^T(I-z\beta)^{-1}1, \beta = \alpha+\Gamma\f$.
+		\f$R-\hat R\f$ is rational of degree \f$s\f$, so it vanishes identically
+		if it vanishes in \f$s+1\f$ points. This is the case for ROS3P and ROS3PW.'''
+		s = self.num_stages
+		beta = np.asarray(self.alpha+self.gamma)
+		one = np.ones(s)
+		for z in -np.arange(1.,s+2):
+			x = np.linalg.solve(np.eye(s)-z*beta,one)
+			if abs(z*np.dot(self.bhat-self.b,x)) > 1e-12:
+				return False
+		return True
+
+	def integrate(self,sys,F,dtF,M,t0,tend,dt,u,vecsrc,veccpy,zero,axpy,norm,controller,callback=None):
+		'''Integrates from t0 to tend with adaptive step sizes
+
+		The step sizes are chosen by `controller` (e.g. a PIController) from the
+		error estimate of the embedded method. Rejected steps are repeated
+		from the saved state with a smaller step size. The workspace is
+		acquired once for the whole integration, see LIRKStepper.
+
+		*Note:* For some methods (ROS3P, ROS3PW) the error estimate vanishes
+		for linear autonomous problems, e.g. Stokes with constant boundary
+		values and sources, so the step size grows to dt_max regardless of
+		the tolerance. A warning is issued for them, see
+		linear_estimate_vanishes(). A ValueError is raised for methods without
+		a usable embedded method at all (LI_EULER, ROS2).
+
+		Keyword arguments (see also step()):
+
+		t0          -- start time
+		tend        -- end time
+		dt          -- initial step size
+		u           -- initial value, overwritten with the solution at tend
+		norm        -- function; norm(v) should return the norm of the error estimate v
+		controller  -- step size controller
+		callback    -- function; callback(t,dt,u) is called after every accepted step
+
+		Returns the step size proposed for the next step.'''
+
+		self.check_embedded()
+		stepper = LIRKStepper(self,vecsrc,veccpy,zero,axpy)
+		return stepper.integrate(sys,F,dtF,M,t0,tend,dt,u,norm,controller,callback)
+
+	def compile(self,n,M=None,J=None,factorization=None,dt=None):
+		'''Returns a StagePlan of the method for numpy arrays of size n'''
+		return StagePlan(self,n,M,J,factorization,dt)
+
+	def compile_ensemble(self,N,n,J,M=None):
+		'''Returns an EnsemblePlan of the method for N systems of size n'''
+		return EnsemblePlan(self,N,n,J,M)
+
+
+class LIRKStepper():
+	'''LIRK method with a workspace that is reused for all steps
+
+	LIRK.step() acquires \f$s+2\f$ vectors with vecsrc in every call. A
+	stepper acquires the stage vectors, the temporary vectors and the error
+	estimate once and reuses them for all steps of a run, so for large
+	problems there is no allocation in the time loop.
+
+	*Note:* The error estimate returned by step() is part of the workspace and
+	is overwritten by the next step.'''
+
+	def __init__(self,scheme,vecsrc,veccpy,zero,axpy,vecbytes=None):
+		'''Keyword arguments:
+
+		scheme      -- the LIRK method
+		vecsrc      -- function; vecsrc(k) should return storage for k vectors as a python list
+		veccpy      -- function; veccpy(a,b) should copy the contents of vector a to b
+		zero        -- function; reset all values of a vector to 0
+		axpy        -- axpy(x,a,y) should realize the axpy function x += a*y
+		vecbytes    -- function; vecbytes(v) should return the memory of a vector in bytes.
+		               By default, v.nbytes (numpy) or 8*v.size() (dolfin) is used.'''
+
+		self.scheme = scheme
+		self.vecsrc = vecsrc
+		self.veccpy = veccpy
+		self.zero = zero
+		self.axpy = axpy
+		self.vecbytes = vecbytes
+
+		self.U_ni = vecsrc(scheme.num_stages)
+		self.rhs, self.ui = vecsrc(2)
+		self.err_est = vecsrc(1)[0] if scheme.bhat.any() else None
+		# backup of the state for rejected steps, acquired by integrate()
+		self.u_old = None
+
+	def step(self,sys,F,dtF,M,t,dt,u):
+		'''Executes one LIRK step, see LIRK.step()'''
+		return self.scheme._step(sys,F,dtF,M,t,dt,u,self.veccpy,self.zero,self.axpy,
+			self.U_ni,self.rhs,self.ui,self.err_est)
+
+	def integrate(self,sys,F,dtF,M,t0,tend,dt,u,norm,controller,callback=None):
+		'''Integrates from t0 to tend with adaptive step sizes, see LIRK.integrate()'''
+
+		self.scheme.check_embedded()
+		if self.u_old is None:
+			self.u_old = self.vecsrc(1)[0]
+
+		def step(t,dt):
+			return norm(self.step(sys,F,dtF,M,t,dt,u))/controller.tol
+		def save():
+			self.veccpy(u,self.u_old)
+		def restore():
+			self.veccpy(self.u_old,u)
+		if callback is not None:
+			accepted = lambda t,dt: callback(t,dt,u)
+		else:
+			accepted = None
+
+		return controller.integrate(step,t0,tend,dt,save,restore,accepted)
+
+	def vectors(self):
+		'''Returns all vectors of the workspace'''
+		vecs = list(self.U_ni) + [self.rhs, self.ui]
+		if self.err_est is not None:
+			vecs.append(self.err_est)
+		if self.u_old is not None:
+			vecs.append(self.u_old)
+		return vecs
+
+	@property
+	def nbytes(self):
+		'''Memory footprint of the workspace in bytes'''
+		if self.vecbytes is not None:
+			vecbytes = self.vecbytes
+		else:
+			def vecbytes(v):
+				if hasattr(v,'nbytes'):
+					return v.nbytes
+				return 8*v.size()
+		return sum(vecbytes(v) for v in self.vectors())
+
+
+class StagePlan():
+	'''LIRK method compiled for numpy arrays
+
+	The stage coefficients are stored as contiguous float arrays and all
+	stages are kept in one array \f$U\in R^{s\times n}\f$, such that the
+	linear combinations \f$\sum_j a_{ij}U_{nj}\f$, \f$\sum_j c_{ij}U_{nj}\f$ and
+	\f$\sum_i m_iU_{ni}\f$ are single matrix-vector products instead of
+	loops over callbacks. The mass matrix is applied once per stage to the
+	combined vector.
+
+	Instead of the `sys` and `M` callbacks, the Jacobian \f$J=\partial_u F\f$
+	(a dense or scipy.sparse matrix) and the mass matrix are given. The system
+	matrix \f$M/(\tau\gamma) - J\f$ is factorized once per step size and
+	reused for all stages and steps. Alternatively, a factorization object
+	with a method solve(rhs) for the system matrix of a fixed step size dt can
+	be passed; steps with another step size are then rejected.
+
+	The Jacobian is kept fixed, i.e. for nonlinear problems the scheme
+	should be a W-method (ROS3PW, ROS34PW2, ROS34PW3).'''
+
+	def __init__(self,scheme,n,M=None,J=None,factorization=None,dt=None):
+		'''Keyword arguments:
+
+		scheme        -- the LIRK method
+		n             -- size of the state vector
+		M             -- mass matrix (dense or sparse), None for the identity
+		J             -- Jacobian \f$\partial_u F\f$ (dense or sparse)
+		factorization -- object with a method solve(rhs) that solves with
+		                 \f$M/(\tau\gamma) - J\f$; only used if J is None
+		dt            -- the step size \f$\tau\f$ of factorization'''
+
+		if J is None and factorization is None:
+			raise ValueError('Either the Jacobian J or a factorization has to be given')
+		if J is None and dt is None:
+			raise ValueError('The step size dt of the factorization has to be given')
+
+		self.scheme = scheme
+		self.n = n
+		self.M = M
+		self.J = J
+
+		s = scheme.num_stages
+		self.a = np.ascontiguousarray(np.asarray(scheme.a),dtype=float)
+		self.c = np.ascontiguousarray(np.asarray(scheme.c),dtype=float)
+		self.m = np.ascontiguousarray(scheme.m,dtype=float)
+		self.alpha_i = np.ascontiguousarray(np.ravel(scheme.alpha_i),dtype=float)
+		self.gamma_i = np.ascontiguousarray(np.ravel(scheme.gamma_i),dtype=float)
+		self.gamma_diag = float(scheme.gamma_diag)
+		if scheme.bhat.any():
+			self.e = np.ascontiguousarray(scheme.mhat-scheme.m,dtype=float)
+		else:
+			self.e = None
+
+		# workspace
+		self.U = np.zeros((s,n))
+		self.rhs = np.zeros(n)
+		self.ui = np.zeros(n)
+		self.err_est = np.zeros(n) if self.e is not None else None
+
+		self._factorization = factorization
+		self._factorization_dt = dt if J is None else None
+
+	@property
+	def nbytes(self):
+		'''Memory footprint of the workspace in bytes'''
+		vecs = [self.U,self.rhs,self.ui]
+		if self.err_est is not None:
+			vecs.append(self.err_est)
+		return sum(v.nbytes for v in vecs)
+
+	def factorize(self,dt):
+		'''Returns the factorization of \f$M/(\tau\gamma) - J\f$ for \f$\tau\f$ = dt'''
+		if self.J is None:
+			if dt != self._factorization_dt:
+				raise ValueError('The factorization belongs to dt={}, not dt={}'.format(self._factorization_dt,dt))
+			return self._factorization
+		if self._factorization_dt == dt:
+			return self._factorization
+
+		fac = dt*self.gamma_diag
+		import scipy.sparse
+		if scipy.sparse.issparse(self.J):
+			from scipy.sparse.linalg import splu
+			if self.M is None:
+				Mf = scipy.sparse.identity(self.n,format='csc')
+			else:
+				Mf = scipy.sparse.csc_matrix(self.M)
+			self._factorization = splu(scipy.sparse.csc_matrix(Mf/fac - self.J))
+		else:
+			from scipy.linalg import lu_factor, lu_solve
+			if self.M is None:
+				Mf = np.identity(self.n)
+			else:
+				Mf = np.asarray(self.M.todense() if scipy.sparse.issparse(self.M) else self.M)
+			lu = lu_factor(Mf/fac - np.asarray(self.J))
+			self._factorization = _DenseLU(lu,lu_solve)
+		self._factorization_dt = dt
+		return self._factorization
+
+	def step(self,F,t,dt,u,dtF=None):
+		'''Executes one LIRK step
+
+		Keyword arguments:
+
+		F           -- function; F(t,u) returns the right-hand side \f$F(t,u)\f$ as an array
+		t           -- time \f$t_n\f$
+		dt          -- time step size \f$\tau\f$
+		u           -- array from old time step \f$u_n\f$, overwritten with \f$u_{n+1}\f$
+		dtF         -- function; dtF(t,u) returns \f$\partial_t F(t,u)\f$, None for autonomous problems
+
+		Returns the error estimate of the embedded method (part of the
+		workspace) or None.'''
+
+		lu = self.factorize(dt)
+		U = self.U
+		rhs = self.rhs
+		ui = self.ui
+		dtFn = dtF(t,u) if dtF is not None else None
+
+		for i in range(self.scheme.num_stages):
+			ti = t + self.alpha_i[i]*dt
+			if i > 0:
+				np.dot(self.a[i,:i],U[:i],out=ui)
+				ui += u
+				rhs[:] = F(ti,ui)
+				np.dot(self.c[i,:i],U[:i],out=ui)
+				ui /= dt
+				rhs += ui if self.M is None else self.M.dot(ui)
+			else:
+				rhs[:] = F(ti,u)
+			if dtFn is not None:
+				rhs += (dt*self.gamma_i[i])*dtFn
+			U[i] = lu.solve(rhs)
+
+		u += np.dot(self.m,U)
+		if self.e is not None:
+			np.dot(self.e,U,out=self.err_est)
+			return self.err_est
+
+	def integrate(self,F,t0,tend,dt,u,controller,dtF=None,norm=None,callback=None):
+		'''Integrates from t0 to tend with adaptive step sizes, see LIRK.integrate()
+
+		The default norm is the root mean square of the error estimate.'''
+
+		self.scheme.check_embedded()
+		if self.J is None:
+			raise ValueError('Adaptive step sizes require the Jacobian J')
+		if norm is None:
+			norm = lambda v: sqrt(np.dot(v,v)/len(v))
+		u_old = np.empty_like(u)
+
+		def step(t,dt):
+			return norm(self.step(F,t,dt,u,dtF))/controller.tol
+		def save():
+			u_old[:] = u
+		def restore():
+			u[:] = u_old
+		if callback is not None:
+			accepted = lambda t,dt: callback(t,dt,u)
+		else:
+			accepted = None
+
+		return controller.integrate(step,t0,tend,dt,save,restore,accepted)
+
+
+class EnsemblePlan():
+	'''LIRK method for an ensemble of independent systems
+
+	Advances N independent systems of size n at once. The state is an array
+	of shape (N,n), time and step size may differ for each member (arrays
+	of shape (N,)). All operations are vectorized over the ensemble, so the
+	number of python calls per step does not depend on N.
+
+	The Jacobian J and the mass matrix M are dense and either shared by all
+	members (shape (n,n)) or given per member (shape (N,n,n)). The system
+	matrices \f$M/(\tau\gamma) - J\f$ are inverted once per set of step
+	sizes, which is intended for small n (ensembles of ODE/DAE systems, not
+	discretized PDEs).'''
+
+	def __init__(self,scheme,N,n,J,M=None):
+		'''Keyword arguments:
+
+		scheme      -- the LIRK method
+		N           -- number of members
+		n           -- size of each system
+		J           -- Jacobian \f$\partial_u F\f$, shape (n,n) or (N,n,n)
+		M           -- mass matrix, shape (n,n) or (N,n,n), None for the identity'''
+
+		self.scheme = scheme
+		self.N = N
+		self.n = n
+		self.J = np.broadcast_to(np.asarray(J,dtype=float),(N,n,n))
+		if M is None:
+			self.M = None
+			M = np.identity(n)
+		else:
+			self.M = np.broadcast_to(np.asarray(M,dtype=float),(N,n,n))
+		self._M = np.broadcast_to(np.asarray(M,dtype=float),(N,n,n))
+
+		s = scheme.num_stages
+		self.a = np.ascontiguousarray(np.asarray(scheme.a),dtype=float)
+		self.c = np.ascontiguousarray(np.asarray(scheme.c),dtype=float)
+		self.m = np.ascontiguousarray(scheme.m,dtype=float)
+		self.alpha_i = np.ascontiguousarray(np.ravel(scheme.alpha_i),dtype=float)
+		self.gamma_i = np.ascontiguousarray(np.ravel(scheme.gamma_i),dtype=float)
+		self.gamma_diag = float(scheme.gamma_diag)
+		if scheme.bhat.any():
+			self.e = np.ascontiguousarray(scheme.mhat-scheme.m,dtype=float)
+		else:
+			self.e = None
+
+		# workspace
+		self.U = np.zeros((s,N,n))
+		self.rhs = np.zeros((N,n))
+		self.ui = np.zeros((N,n))
+		self.err_est = np.zeros((N,n)) if self.e is not None else None
+
+		self._inv = None
+		self._inv_dt = None
+
+	@property
+	def nbytes(self):
+		'''Memory footprint of the workspace and the inverted system matrices in bytes'''
+		arrays = [self.U,self.rhs,self.ui]
+		if self.err_est is not None:
+			arrays.append(self.err_est)
+		if self._inv is not None:
+			arrays.append(self._inv)
+		return sum(a.nbytes for a in arrays)
+
+	def _apply(self,A,x):
+		'''Returns the matrix-vector products A[k]*x[k] for all members'''
+		return np.einsum('kij,kj->ki',A,x)
+
+	def factorize(self,dt):
+		'''Inverts \f$M/(\tau\gamma) - J\f$ for the step sizes dt (scalar or shape (N,))'''
+		dt = np.broadcast_to(np.asarray(dt,dtype=float),(self.N,))
+		if self._inv_dt is None or not np.array_equal(dt,self._inv_dt):
+			S = self._M/(dt*self.gamma_diag)[:,None,None] - self.J
+			self._inv = np.linalg.inv(S)
+			self._inv_dt = dt.copy()
+		return self._inv
+
+	def step(self,F,t,dt,u,dtF=None):
+		'''Executes one LIRK step for all members
+
+		Keyword arguments:
+
+		F           -- function; F(t,u) returns the right-hand sides, shape (N,n), for times t of shape (N,)
+		t           -- times \f$t_n\f$, scalar or shape (N,)
+		dt          -- time step sizes \f$\tau\f$, scalar or shape (N,)
+		u           -- states of shape (N,n), overwritten with \f$u_{n+1}\f$
+		dtF         -- function; dtF(t,u) returns \f$\partial_t F\f$, None for autonomous problems
+
+		Returns the error estimates of the embedded method (shape (N,n), part
+		of the workspace) or None.'''
+
+		Sinv = self.factorize(dt)
+		t = np.broadcast_to(np.asarray(t,dtype=float),(self.N,))
+		dt = self._inv_dt
+		U = self.U
+		rhs = self.rhs
+		ui = self.ui
+		dtFn = dtF(t,u) if dtF is not None else None
+
+		for i in range(self.scheme.num_stages):
+			ti = t + self.alpha_i[i]*dt
+			if i > 0:
+				ui[:] = np.tensordot(self.a[i,:i],U[:i],axes=1)
+				ui += u
+				rhs[:] = F(ti,ui)
+				ui[:] = np.tensordot(self.c[i,:i],U[:i],axes=1)
+				ui /= dt[:,None]
+				rhs += ui if self.M is None else self._apply(self.M,ui)
+			else:
+				rhs[:] = F(ti,u)
+			if dtFn is not None:
+				rhs += (dt*self.gamma_i[i])[:,None]*dtFn
+			U[i] = self._apply(Sinv,rhs)
+
+		u += np.tensordot(self.m,U,axes=1)
+		if self.e is not None:
+			self.err_est[:] = np.tensordot(self.e,U,axes=1)
+			return self.err_est
+
+	def integrate(self,F,t0,tend,dt,u,dtF=None,callback=None):
+		'''Integrates all members from t0 to tend with the step sizes dt
+
+		t0, tend and dt may be scalars or arrays of shape (N,). The last step of
+		each member is shortened to end exactly at tend; members that have
+		reached tend are not changed any more. callback(t,u) is called after
+		every step with the current times of all members.
+
+		Returns the number of steps.'''
+
+		t = np.array(np.broadcast_to(np.asarray(t0,dtype=float),(self.N,)))
+		tend = np.broadcast_to(np.asarray(tend,dtype=float),(self.N,))
+		dt = np.broadcast_to(np.asarray(dt,dtype=float),(self.N,))
+		u_old = np.empty_like(u)
+		num_steps = 0
+		done = tend - t <= 1e-12*np.maximum(abs(tend),1.)
+		while not done.all():
+			dt_step = np.where(done,dt,np.minimum(dt,tend-t))
+			u_old[:] = u
+			self.step(F,t,dt_step,u,dtF)
+			u[done] = u_old[done]
+			t = np.where(done,t,t+dt_step)
+			num_steps += 1
+			if callback is not None:
+				callback(t,u)
+			done = tend - t <= 1e-12*np.maximum(abs(tend),1.)
+		return num_steps
+
+
+class _DenseLU():
+	'''LU factorization of a dense matrix with a solve() method'''
+	def __init__(self,lu,lu_solve):
+		self.lu = lu
+		self.lu_solve = lu_solve
+	def solve(self,rhs):
+		return self.lu_solve(self.lu,rhs)
+
+
+class PIController():
+	'''PI step size controller for embedded LIRK methods
+
+	The error of a step is scaled with the tolerance, a step is accepted if
+	\f$err = \|\hat u_{n+1} - u_{n+1}\|/tol \le 1\f$. The new step size is
+
+	\f[\tau_{new} = \tau\cdot safety\cdot err_n^{-0.7/q} err_{n-1}^{0.4/q}\f]
+
+	where \f$q\f$ is the order of the method, see E. Hairer, S. P. Norsett,
+	G. Wanner: Solving Ordinary Differential Equations I, Springer, 2nd edition,
+	Section II.4.
+	After a rejection, the step size is reduced with \f$err^{-1/q}\f$ and not
+	increased in the following step. The factor by which the step size may
+	change is bounded by fac_min and fac_max, the step size itself by dt_min
+	and dt_max.
+
+	*Note:* The controller only sees the error estimate. If it vanishes (see
+	LIRK.linear_estimate_vanishes()), every step is accepted and the step
+	size only bounded by dt_max.'''
+
+	def __init__(self,tol,order,dt_min=0.,dt_max=float('inf'),safety=.9,fac_min=.2,fac_max=5.):
+		'''Keyword arguments:
+
+		tol         -- tolerance for the error estimate
+		order       -- order \f$q\f$ of the method, usually LIRK.order
+		dt_min      -- smallest step size; a rejection at dt_min raises a RuntimeError
+		dt_max      -- largest step size
+		safety      -- safety factor
+		fac_min     -- smallest factor for step size changes
+		fac_max     -- largest factor for step size changes'''
+
+		self.tol = tol
+		self.order = order
+		self.dt_min = dt_min
+		self.dt_max = dt_max
+		self.safety = safety
+		self.fac_min = fac_min
+		self.fac_max = fac_max
+		self.reset()
+
+	def reset(self):
+		'''Forget the history of the controller'''
+		self.err_old = 1.
+		self.rejected = False
+		self.num_accepted = 0
+		self.num_rejected = 0
+
+	def propose(self,err,dt):
+		'''Decides about a step of size dt with scaled error err
+
+		Returns a tuple (accepted, new step size).'''
+
+		q = float(self.order)
+		# avoid division by zero for exact steps
+		err = max(err,1e-10)
+		if err <= 1:
+			fac = self.safety * err**(-.7/q) * self.err_old**(.4/q)
+			if self.rejected:
+				fac = min(fac,1.)
+			self.err_old = err
+			self.rejected = False
+			self.num_accepted += 1
+		else:
+			if dt <= self.dt_min:
+				raise RuntimeError('Step rejected at minimal step size dt_min={}'.format(self.dt_min))
+			fac = self.safety * err**(-1./q)
+			self.rejected = True
+			self.num_rejected += 1
+		fac = min(self.fac_max,max(self.fac_min,fac))
+		return not self.rejected, min(self.dt_max,max(self.dt_min,fac*dt))
+
+	def integrate(self,step,t0,tend,dt,save,restore,callback=None):
+		'''Drives a whole integration from t0 to tend
+
+		Keyword arguments:
+
+		step        -- function; step(t,dt) advances the state and returns the scaled error
+		t0          -- start time
+		tend        -- end time
+		dt          -- initial step size
+		save        -- function; save() stores the state before a step
+		restore     -- function; restore() resets the state after a rejected step
+		callback    -- function; callback(t,dt) is called after every accepted step
+
+		Returns the step size proposed for the next step.'''
+
+		t = t0
+		dt = min(self.dt_max,max(self.dt_min,dt))
+		while tend - t > 1e-12*max(abs(tend),1.):
+			dt_step = min(dt,tend-t)
+			save()
+			err = step(t,dt_step)
+			accepted, dt = self.propose(err,dt_step)
+			if accepted:
+				t += dt_step
+				if callback is not None:
+					callback(t,dt_step)
+			else:
+				restore()
+		return dt
 
 # Linearly implicit Euler method
 # see any Numerics book, e.g. Deuflhard/Bornemann, Numerische Mathematik 2, 3. Auflage, p. 293.
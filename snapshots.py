@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+'''Binary snapshot store for time series of dof vectors.
+
+All snapshots of a run go into a single store instead of one file per time
+step. The mesh and the dof maps are written once, the dof vectors of each
+field are appended row by row. Two layouts are supported:
+
+  "hdf5" -- one HDF5 file with chunked, optionally gzip compressed datasets
+            (needs h5py)
+  "npy"  -- a directory with one raw binary file per field that is appended
+            to and memory-mapped by the reader (uncompressed)
+
+The SnapshotReader gives access to single steps without loading the whole
+time series.'''
+
+import os
+import json
+import numpy as np
+
+try:
+	import h5py
+except ImportError:
+	h5py = None
+
+
+def _backend(path, backend):
+	if backend == 'auto':
+		if os.path.isdir(path) or h5py is None:
+			return 'npy'
+		return 'hdf5'
+	if backend not in ['hdf5', 'npy']:
+		raise ValueError("Snapshot backend '%s' unknown." % backend)
+	if backend == 'hdf5' and h5py is None:
+		raise ImportError('The hdf5 snapshot backend needs h5py.')
+	return backend
+
+
+class SnapshotWriter():
+	'''Appends dof vectors of the fields to a snapshot store.
+
+	fields maps the field names to the lengths of their dof vectors. mesh
+	and dofmaps are dicts of arrays that are stored once (e.g. the vertex
+	coordinates and cells of the mesh and the dofs of each field in the
+	numbering of the mixed space).
+
+	With append=True, an existing store is continued (e.g. by a restarted
+	run) instead of overwritten; its fields have to match.'''
+
+	def __init__(self, path, fields, mesh=None, dofmaps=None, backend='auto',
+			compression=False, dtype=np.float64, append=False):
+		self.path = path
+		self.fields = dict(fields)
+		self.dtype = np.dtype(dtype)
+		self.backend = _backend(path, backend)
+		self.count = 0
+		mesh = mesh or {}
+		dofmaps = dofmaps or {}
+
+		if append and os.path.exists(path):
+			self._open_append()
+		elif self.backend == 'hdf5':
+			self._h5 = h5py.File(path, 'w')
+			opts = {'compression': 'gzip'} if compression else {}
+			for name, n in self.fields.items():
+				self._h5.create_dataset('fields/'+name, shape=(0,n), maxshape=(None,n),
+						chunks=(1,n), dtype=self.dtype, **opts)
+			self._h5.create_dataset('t', shape=(0,), maxshape=(None,), chunks=(1024,),
+					dtype=np.float64)
+			for name, arr in mesh.items():
+				self._h5['mesh/'+name] = np.asarray(arr)
+			for name, arr in dofmaps.items():
+				self._h5['dofmaps/'+name] = np.asarray(arr)
+		else:
+			if not os.path.isdir(path):
+				os.makedirs(path)
+			meta = {'fields': self.fields, 'dtype': self.dtype.str}
+			with open(os.path.join(path, 'meta.json'), 'w') as f:
+				json.dump(meta, f)
+			np.savez(os.path.join(path, 'mesh.npz'), **mesh)
+			np.savez(os.path.join(path, 'dofmaps.npz'), **dofmaps)
+			self._files = dict((name, open(os.path.join(path, name+'.bin'), 'wb'))
+					for name in self.fields)
+			self._t = open(os.path.join(path, 't.bin'), 'wb')
+
+	def _open_append(self):
+		reader = SnapshotReader(self.path, self.backend)
+		fields = reader.fields
+		dtype = reader.dtype
+		self.count = len(reader)
+		reader.close()
+		if fields != self.fields or dtype != self.dtype:
+			raise ValueError("Snapshot store '%s' has different fields." % self.path)
+		if self.backend == 'hdf5':
+			self._h5 = h5py.File(self.path, 'a')
+		else:
+			self._files = dict((name, open(os.path.join(self.path, name+'.bin'), 'ab'))
+					for name in self.fields)
+			self._t = open(os.path.join(self.path, 't.bin'), 'ab')
+		# a killed writer may have written fields of a step without its time
+		self._resize(self.count)
+
+	def _resize(self, count):
+		self.count = count
+		if self.backend == 'hdf5':
+			for name in self.fields:
+				self._h5['fields/'+name].resize(count, axis=0)
+			self._h5['t'].resize(count, axis=0)
+		else:
+			for name, f in self._files.items():
+				f.truncate(count*self.fields[name]*self.dtype.itemsize)
+			self._t.truncate(count*8)
+
+	def truncate(self, t):
+		'''drop all steps after time t (e.g. written after the checkpoint of a restart)'''
+		self.flush()
+		if self.backend == 'hdf5':
+			times = self._h5['t'][:]
+		else:
+			times = np.fromfile(os.path.join(self.path, 't.bin'), dtype=np.float64)
+		self._resize(int(np.sum(times <= t + 1e-12*max(1., abs(t)))))
+
+	def append(self, t, **vectors):
+		'''append the vectors of all fields at time t'''
+		if set(vectors) != set(self.fields):
+			raise ValueError('Snapshot needs the fields %s.' % sorted(self.fields))
+		# check all fields before writing any, so a failed append writes nothing
+		vectors = dict((name, np.asarray(vec, dtype=self.dtype).reshape(-1))
+				for name, vec in vectors.items())
+		for name, vec in vectors.items():
+			if len(vec) != self.fields[name]:
+				raise ValueError("Field '%s' has %d dofs, got %d." % (name, self.fields[name], len(vec)))
+		for name, vec in vectors.items():
+			if self.backend == 'hdf5':
+				dset = self._h5['fields/'+name]
+				dset.resize(self.count+1, axis=0)
+				dset[self.count] = vec
+			else:
+				vec.tofile(self._files[name])
+		if self.backend == 'hdf5':
+			self._h5['t'].resize(self.count+1, axis=0)
+			self._h5['t'][self.count] = t
+		else:
+			# t is written last, so a reader never sees a step without data
+			np.array([t], dtype=np.float64).tofile(self._t)
+		self.count += 1
+
+	def flush(self):
+		if self.backend == 'hdf5':
+			self._h5.flush()
+		else:
+			for f in self._files.values():
+				f.flush()
+			self._t.flush()
+
+	def close(self):
+		if self.backend == 'hdf5':
+			self._h5.close()
+		else:
+			for f in self._files.values():
+				f.close()
+			self._t.close()
+
+
+class SnapshotReader():
+	'''Read access to a snapshot store written by SnapshotWriter.
+
+	The steps are memory-mapped (npy) or read on demand from the chunked
+	datasets (hdf5).'''
+
+	def __init__(self, path, backend='auto'):
+		self.path = path
+		self.backend = _backend(path, backend)
+		if self.backend == 'hdf5':
+			self._h5 = h5py.File(path, 'r')
+			self.fields = dict((name, dset.shape[1]) for name, dset in self._h5['fields'].items())
+			dsets = list(self._h5['fields'].values())
+			self.dtype = np.dtype(dsets[0].dtype if dsets else np.float64)
+			self.times = self._h5['t'][:]
+		else:
+			with open(os.path.join(path, 'meta.json')) as f:
+				meta = json.load(f)
+			self.fields = dict((str(name), n) for name, n in meta['fields'].items())
+			self.dtype = np.dtype(str(meta['dtype']))
+			self.times = np.fromfile(os.path.join(path, 't.bin'), dtype=np.float64)
+
+	def __len__(self):
+		return len(self.times)
+
+	def field(self, name):
+		'''all steps of a field as an array of shape (steps, dofs) (not loaded)'''
+		if self.backend == 'hdf5':
+			return self._h5['fields/'+name]
+		if len(self) == 0:
+			# an empty file cannot be memory-mapped
+			return np.empty((0, self.fields[name]), dtype=self.dtype)
+		return np.memmap(os.path.join(self.path, name+'.bin'), dtype=self.dtype, mode='r',
+				shape=(len(self), self.fields[name]))
+
+	def read(self, name, step):
+		'''dof vector of a field in a step (negative steps count from the end)'''
+		return self.field(name)[step]
+
+	def mesh(self):
+		'''dict of the mesh arrays'''
+		return self._group('mesh')
+
+	def dofmaps(self):
+		'''dict of the dof maps'''
+		return self._group('dofmaps')
+
+	def _group(self, name):
+		if self.backend == 'hdf5':
+			if name not in self._h5:
+				return {}
+			return dict((key, dset[...]) for key, dset in self._h5[name].items())
+		with np.load(os.path.join(self.path, name+'.npz')) as data:
+			return dict((key, data[key]) for key in data.files)
+
+	def close(self):
+		if self.backend == 'hdf5':
+			self._h5.close()
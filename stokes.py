@@ -1,28 +1,53 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 import math
+import bisect
+import collections
 import numpy as np
 from dolfin import *
-from scipy.sparse.linalg import LinearOperator
-from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import LinearOperator, factorized
+from scipy.sparse import csr_matrix, spdiags
+import scipy.linalg
 from numpy import intc
 # krypy: https://github.com/andrenarchy/krypy
 from krypy.krypy import linsys, utils
 from pyamg import smoothed_aggregation_solver
+from pyamg.multilevel import multilevel_solver
+from pyamg.relaxation.smoothing import change_smoothers
+import multiprocessing
+import json
+from contextlib import contextmanager
+from timeit import default_timer as timer
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import hashlib
+import os
+import errno
+import tempfile
 #from solver_diagnostics import solver_diagnostics # pyamg
 from matplotlib import pyplot as pp
+import lirk
+from snapshots import SnapshotWriter
 
 parameters.linear_algebra_backend = "uBLAS"
 
 def main():
     stokes_eoc2d()
 
-def stokes_karman2d():
+def karman2d_problem(mesh_file='msh_karman2d.xml'):
+    '''mesh and boundary conditions of the 2d Karman vortex street benchmark
+
+    Returns the mesh and the keyword arguments of solve_stokes that define
+    the problem.
+    '''
     # cf. Schäfer and Turek, Benchmark Computations of Laminar Flow Around a Cylinder, 1996
     # the mesh can be generated by
     #  $ gmsh -2 -clmax 0.025 msh_karman2d.geo
     #  $ dolfin-convert msh_karman2d.msh msh_karman2d.xml
-    mesh = Mesh('msh_karman2d.xml')
+    mesh = Mesh(mesh_file)
     boundaries = MeshFunction('size_t', mesh, mesh.topology().dim()-1)
     boundaries.set_all(0)
 
@@ -41,22 +66,24 @@ def stokes_karman2d():
             1: Constant((0.0,0.0)),
             2: Expression(('4*x[1]*(0.41-x[1])/(0.41*0.41)','0.0'))
             }
-    sol = solve_stokes(mesh, 
+    return mesh, dict(
             u_init = Constant((0.0,0.0)),
             f = Constant((0.0,0.0)),
             boundaries = boundaries,
             dbcs = dbcs,
-            scale_dt=0.01,
-            u_file = File("results/velocity.pvd"),
-            p_file = File("results/pressure.pvd"),
             )
 
-def stokes_karman3d():
+def karman3d_problem(mesh_file='msh_karman3d.xml'):
+    '''mesh and boundary conditions of the 3d Karman vortex street benchmark
+
+    Returns the mesh and the keyword arguments of solve_stokes that define
+    the problem.
+    '''
     # cf. Schäfer and Turek, Benchmark Computations of Laminar Flow Around a Cylinder, 1996
     # the mesh can be generated by
     #  $ gmsh -3 -clmax 0.04 msh_karman3d.geo
     #  $ dolfin-convert msh_karman3d.msh msh_karman3d.xml
-    mesh = Mesh('msh_karman3d.xml')
+    mesh = Mesh(mesh_file)
     boundaries = MeshFunction('size_t', mesh, mesh.topology().dim()-1)
     boundaries.set_all(0)
 
@@ -76,17 +103,53 @@ def stokes_karman3d():
             1: Constant((0.0,0.0,0.0)),
             2: Expression(('sin(pi*x[1]/0.41)*sin(pi*x[2]/0.41)','0.0','0.0'))
             }
-    sol = solve_stokes(mesh, 
+    return mesh, dict(
             u_init = Constant((0.0,0.0,0.0)),
             f = Constant((0.0,0.0,0.0)),
             boundaries = boundaries,
             dbcs = dbcs,
+            )
+
+def stokes_karman2d():
+    mesh, problem = karman2d_problem()
+    sol = solve_stokes(mesh, 
             scale_dt=0.01,
+            prec_cache = "cache/amg",
             u_file = File("results/velocity.pvd"),
             p_file = File("results/pressure.pvd"),
+            **problem
+            )
+
+def stokes_karman3d(restart=False):
+    '''3d Karman vortex street with checkpoints
+
+    With restart=True the run resumes from the latest checkpoint of an
+    interrupted run. dolfin Files cannot be continued, so the resumed run
+    writes to files named after the step it resumes from.
+    '''
+    mesh, problem = karman3d_problem()
+    checkpoint = Checkpointer("checkpoints/karman3d")
+    name = "results/%s.pvd"
+    if restart:
+        state = checkpoint.latest()
+        if state is not None:
+            name = "results/%%s_from%08d.pvd" % int(state['n_step'])
+    sol = solve_stokes(mesh, 
+            scale_dt=0.01,
+            prec_cache = "cache/amg",
+            checkpoint = checkpoint,
+            restart = restart,
+            u_file = File(name % "velocity"),
+            p_file = File(name % "pressure"),
+            **problem
             )
 
-def stokes_eoc2d(refines = 3):
+def eoc2d_problem(refine):
+    '''problem with known solution on a UnitSquareMesh with 2**refine cells per direction
+
+    Returns the mesh and the keyword arguments of solve_stokes that define
+    the problem (including the exact solution u_ex, p_ex).
+    '''
     alpha = 20
     beta = 5
 
@@ -108,53 +171,153 @@ def stokes_eoc2d(refines = 3):
     p_ex = Expression(("exp(beta*t*x[0])+exp(beta*t*x[1])"), beta=beta, t=0)
     f = Expression(( dt_u0+" - "+d00_u0+" + "+d0_p, dt_u1+" - "+d11_u1+" + "+d1_p), alpha=alpha, beta=beta, t=0)
 
-    hmax = []
-    u_err_norms = []
-    p_err_norms = []
-    for refine in range(2,3+refines):
-        n_gridpoints = 2**refine
-        mesh = UnitSquareMesh(n_gridpoints,n_gridpoints)
-        boundaries = MeshFunction('size_t', mesh, mesh.topology().dim()-1)
-        class Boundary(SubDomain):
-            def inside(self, x, on_boundary):
-                return on_boundary
-        boundaries.set_all(0)
-        Boundary().mark(boundaries, 1)
-        dbcs = {1: u_ex}
-
-        sol = solve_stokes(mesh,
-                u_init = u_ex,
-                f = f,
-                lagrange_mult = True,
-                boundaries = boundaries,
-                dbcs = dbcs,
-                expressions = [u_ex, p_ex],
-                scale_dt = 0.2,
-                linsolver = 'petsc',
-                tend = 1,
-                u_file = File("results/eoc2d_%02d_velocity.pvd" % refine),
-                p_file = File("results/eoc2d_%02d_pressure.pvd" % refine),
-                u_ex = u_ex,
-                p_ex = p_ex,
-                u_err_file = File("results/eoc2d_%02d_velocity_error.pvd" % refine),
-                p_err_file = File("results/eoc2d_%02d_pressure_error.pvd" % refine)
-                )
-        hmax.append(mesh.hmax())
-        u_err_norms.append( max(sol['u_err_norms']) )
-        p_err_norms.append( max(sol['p_err_norms']) )
-
-        print('max(u_err_norms):', max(sol['u_err_norms']))
-        print('max(p_err_norms):', max(sol['p_err_norms']))
-    hmax = np.array(hmax)
-    u_err_norms = np.array(u_err_norms)
-    p_err_norms = np.array(p_err_norms)
-
-    u_eoc = np.log(u_err_norms[1:]/u_err_norms[:-1]) / np.log(hmax[1:]/hmax[:-1])
-    p_eoc = np.log(p_err_norms[1:]/p_err_norms[:-1]) / np.log(hmax[1:]/hmax[:-1])
-
-    pp.loglog(hmax, u_err_norms)
-    pp.loglog(hmax, p_err_norms)
-    pp.show()
+    n_gridpoints = 2**refine
+    mesh = UnitSquareMesh(n_gridpoints,n_gridpoints)
+    boundaries = MeshFunction('size_t', mesh, mesh.topology().dim()-1)
+    class Boundary(SubDomain):
+        def inside(self, x, on_boundary):
+            return on_boundary
+    boundaries.set_all(0)
+    Boundary().mark(boundaries, 1)
+    dbcs = {1: u_ex}
+
+    return mesh, dict(
+            u_init = u_ex,
+            f = f,
+            lagrange_mult = True,
+            boundaries = boundaries,
+            dbcs = dbcs,
+            expressions = [u_ex, p_ex],
+            u_ex = u_ex,
+            p_ex = p_ex,
+            )
+
+def eoc2d_run(refine, scale_dt, linsolver='petsc', n_defl=0, prec_cache="cache/amg", **kwargs):
+    '''run one level (refine, scale_dt) of stokes_eoc2d
+
+    Returns hmax and the maximal error norms over time, and the solution
+    dict of solve_stokes. kwargs are passed to solve_stokes. The AMG cache
+    prec_cache is only used by the solvers with an AMG preconditioner.
+    '''
+    if linsolver not in ['krypy', 'minres']:
+        prec_cache = None
+    mesh, problem = eoc2d_problem(refine)
+    problem.update(kwargs)
+    name = "results/eoc2d_%02d_dt%g" % (refine, scale_dt)
+    sol = solve_stokes(mesh,
+            scale_dt = scale_dt,
+            linsolver = linsolver,
+            n_defl = n_defl,
+            prec_cache = prec_cache,
+            tend = 1,
+            u_file = File(name + "_velocity.pvd"),
+            p_file = File(name + "_pressure.pvd"),
+            u_err_file = File(name + "_velocity_error.pvd"),
+            p_err_file = File(name + "_pressure_error.pvd"),
+            **problem
+            )
+    print('max(u_err_norms):', max(sol['u_err_norms']))
+    print('max(p_err_norms):', max(sol['p_err_norms']))
+    return {
+            'refine': refine,
+            'scale_dt': scale_dt,
+            'hmax': mesh.hmax(),
+            'u_err': max(sol['u_err_norms']),
+            'p_err': max(sol['p_err_norms']),
+            'iterations': sum(it for record in sol['stats']
+                              for it in record['iterations'] if it is not None),
+            }, sol
+
+def eoc2d_level(args):
+    '''run one level (refine, scale_dt, linsolver, n_defl) of stokes_eoc2d
+
+    The expressions are built in here, so this can run in a worker process.
+    '''
+    return eoc2d_run(*args)[0]
+
+def eoc2d_nested(args):
+    '''run all levels (refines, scale_dt, linsolver, n_defl) of stokes_eoc2d with nested iteration
+
+    The levels run from coarse to fine. The solution history and the
+    deflation vectors of each level are prolongated to the next level as
+    initial guesses and initial deflation space. The direct solvers do not
+    use initial guesses, so with them the levels just run one after another.
+    '''
+    refines, scale_dt, linsolver, n_defl = args
+    results = []
+    history = None
+    Z = None
+    for k, refine in enumerate(refines):
+        # only the levels with a finer successor keep their history, and
+        # only the iterative solvers can use it
+        keep_history = k < len(refines)-1 and linsolver in ['krypy', 'minres']
+        res, sol = eoc2d_run(refine, scale_dt, linsolver, n_defl, keep_history=keep_history,
+                             initial_guess=history, initial_deflation=Z)
+        results.append(res)
+        history = sol.get('history')
+        Z = sol.get('Z')
+    return results
+
+def stokes_eoc2d(refines = 3, scale_dts = (0.2,), workers = None,
+                 plot_file = "results/eoc2d.png", nested = False,
+                 linsolver = 'petsc', n_defl = 0):
+    '''convergence study on refined UnitSquareMeshes
+
+    The levels (and scale_dt values) are independent and run in a pool of
+    workers processes (all cpus if None, serially if 1). The finest levels are
+    dispatched first, so the study takes about as long as the finest level.
+
+    With nested=True, the levels of each scale_dt run one after another and
+    each level starts from the prolongated solution (and deflation vectors)
+    of the coarser one (see eoc2d_nested). The initial guesses only pay off
+    for the iterative solver linsolver='krypy'.
+    Returns the EOCs of u and p for each scale_dt.
+    '''
+    if nested:
+        func = eoc2d_nested
+        tasks = [(list(range(2,3+refines)), scale_dt, linsolver, n_defl)
+                 for scale_dt in scale_dts]
+    else:
+        func = eoc2d_level
+        tasks = [(refine, scale_dt, linsolver, n_defl) for scale_dt in scale_dts
+                 for refine in reversed(range(2,3+refines))]
+    if workers == 1:
+        results = [func(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(workers)
+        results = pool.map(func, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    if nested:
+        results = [r for res in results for r in res]
+
+    eocs = {}
+    pp.figure()
+    for scale_dt in scale_dts:
+        res = sorted([r for r in results if r['scale_dt'] == scale_dt],
+                     key=lambda r: r['refine'])
+        hmax = np.array([r['hmax'] for r in res])
+        u_err_norms = np.array([r['u_err'] for r in res])
+        p_err_norms = np.array([r['p_err'] for r in res])
+
+        u_eoc = np.log(u_err_norms[1:]/u_err_norms[:-1]) / np.log(hmax[1:]/hmax[:-1])
+        p_eoc = np.log(p_err_norms[1:]/p_err_norms[:-1]) / np.log(hmax[1:]/hmax[:-1])
+        eocs[scale_dt] = (u_eoc, p_eoc)
+
+        print('scale_dt = %g' % scale_dt)
+        print('%10s %12s %8s %12s %8s %8s' % ('hmax', 'u_err', 'u_eoc', 'p_err', 'p_eoc', 'its'))
+        for i in range(len(res)):
+            print('%10.4e %12.4e %8s %12.4e %8s %8d' % (hmax[i], u_err_norms[i],
+                  '%.2f' % u_eoc[i-1] if i > 0 else '-', p_err_norms[i],
+                  '%.2f' % p_eoc[i-1] if i > 0 else '-', res[i]['iterations']))
+
+        pp.loglog(hmax, u_err_norms, label='u, scale_dt=%g' % scale_dt)
+        pp.loglog(hmax, p_err_norms, label='p, scale_dt=%g' % scale_dt)
+    pp.xlabel('hmax')
+    pp.legend(loc='best')
+    pp.savefig(plot_file)
+    pp.close()
+    return eocs
 
 def get_csr_matrix(A):
     '''get csr matrix from dolfin without copying data
@@ -179,6 +342,1241 @@ def getLinearOperator(A):
         return resvec.array()
     return LinearOperator( (A.size(0), A.size(1)), matvec=matvec )
 
+def get_bc_values(dbc):
+    '''get the boundary dofs and their current values of a list of DirichletBCs
+
+    The dofs are returned sorted. If a dof is contained in several boundary
+    conditions, the last one wins (just like with subsequent bc.apply() calls).
+    '''
+    values = {}
+    for bc in dbc:
+        values.update(bc.get_boundary_values())
+    dofs = np.array(sorted(values.keys()), dtype=intc)
+    return dofs, np.array([values[dof] for dof in dofs])
+
+class LRUCache(object):
+    '''dict with at most maxsize entries, the least recently used one is dropped
+
+    Used for the matrices and factorizations that depend on fac: if dt
+    changes, the ones for old values of fac are released.
+    '''
+    def __init__(self, maxsize=2):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+class StokesOperator(object):
+    '''mass and stiffness blocks of the Stokes problem, assembled only once
+
+    The system matrix for a factor fac (dt for implicit Euler, dt*gamma for
+    a LIRK stage) is formed as the sparse linear combination
+
+        A(fac) = mass + fac*stiffness
+
+    of the cached matrices, so a change of fac does not need a reassembly.
+    The matrices for the last two values of fac are kept.
+
+    The Dirichlet boundary conditions are eliminated symmetrically (rows and
+    columns of the boundary dofs are replaced by the identity, like
+    assemble_system does). The eliminated columns are kept as the lifting
+    matrix, so the right hand side for new boundary values only needs
+    b -= lift(fac)*g and b[bc_dofs] = g.
+
+    For the dolfin solvers the matrix with non-symmetrically applied boundary
+    conditions is available through matrix(fac).
+    '''
+    def __init__(self, mass_form, stiffness_form, dbc):
+        self.dbc = dbc
+        self.mass = assemble(mass_form)
+        self.stiffness = assemble(stiffness_form)
+        self.bc_dofs, _ = get_bc_values(dbc)
+
+        M = get_csr_matrix(self.mass).tocsr(copy=True)
+        K = get_csr_matrix(self.stiffness).tocsr(copy=True)
+        n = M.shape[0]
+        is_bc = np.zeros(n, dtype=bool)
+        is_bc[self.bc_dofs] = True
+        keep = spdiags((~is_bc).astype(float), 0, n, n)
+        self._Mi = (keep*M*keep).tocsr()
+        self._Ki = (keep*K*keep).tocsr()
+        self._I_bc = spdiags(is_bc.astype(float), 0, n, n).tocsr()
+        self._Ml = (keep*M[:, self.bc_dofs]).tocsr()
+        self._Kl = (keep*K[:, self.bc_dofs]).tocsr()
+
+        self._systems = LRUCache()
+        self._matrices = LRUCache()
+
+    def system(self, fac):
+        '''csr matrix mass + fac*stiffness with eliminated boundary conditions'''
+        if fac not in self._systems:
+            A = (self._Mi + fac*self._Ki + self._I_bc).tocsr()
+            A.eliminate_zeros()
+            self._systems[fac] = A
+        return self._systems[fac]
+
+    def lift(self, fac):
+        '''eliminated boundary columns of mass + fac*stiffness'''
+        return self._Ml + fac*self._Kl
+
+    def matrix(self, fac):
+        '''dolfin matrix mass + fac*stiffness with applied boundary conditions'''
+        if fac not in self._matrices:
+            A = self.mass.copy()
+            A.axpy(fac, self.stiffness, False)
+            for bc in self.dbc:
+                bc.apply(A)
+            self._matrices[fac] = A
+        return self._matrices[fac]
+
+    def apply_bcs(self, b, fac, g=None):
+        '''apply the boundary values g to the right hand side b (in place)
+
+        If g is None, the current values of the boundary conditions are used.
+        '''
+        if g is None:
+            _, g = get_bc_values(self.dbc)
+        b -= (self.lift(fac)*g).reshape(b.shape)
+        b[self.bc_dofs] = g.reshape(b[self.bc_dofs].shape)
+        return b
+
+    def apply_mass(self, x):
+        '''mass*x with zero rows for the boundary dofs'''
+        return self._Mi*x + self._Ml*x[self.bc_dofs]
+
+    def apply_stiffness(self, x):
+        '''stiffness*x with zero rows for the boundary dofs'''
+        return self._Ki*x + self._Kl*x[self.bc_dofs]
+
+class BlockLayout(object):
+    '''renumbering of the dofs of W such that the blocks are contiguous
+
+    In the new numbering the velocity dofs come first, then the pressure dofs
+    and then the Lagrange multiplier (if any). The blocks of a vector in the
+    new numbering are the slices V, Q and L, i.e. views instead of copies.
+    '''
+    def __init__(self, Vdofs, Qdofs, Ldofs=None):
+        blocks = [np.asarray(list(Vdofs), dtype=intc), np.asarray(list(Qdofs), dtype=intc)]
+        if Ldofs is not None:
+            blocks.append(np.asarray(list(Ldofs), dtype=intc))
+        # perm[new] = old, iperm[old] = new
+        self.perm = np.concatenate(blocks)
+        self.iperm = np.empty_like(self.perm)
+        self.iperm[self.perm] = np.arange(len(self.perm), dtype=intc)
+        nV = len(blocks[0])
+        nQ = len(blocks[1])
+        self.V = slice(0, nV)
+        self.Q = slice(nV, nV+nQ)
+        self.L = slice(nV+nQ, len(self.perm)) if Ldofs is not None else None
+
+    def to_blocks(self, x):
+        '''vector x in the block numbering'''
+        return x[self.perm]
+
+    def from_blocks(self, y):
+        '''vector y in the original numbering'''
+        return y[self.iperm]
+
+    def matrix(self, A):
+        '''csr matrix A in the block numbering
+
+        The permuted matrix is built in a single pass over the nonzeros of A,
+        without intermediate matrices.
+        '''
+        return csr_submatrix(A, self.perm, self.perm, self.iperm)
+
+# block layouts (and dofs of the subspaces) for the last few (mesh, W)
+_block_layouts = LRUCache(maxsize=4)
+
+def get_block_layout(mesh, W, lagrange_mult):
+    '''dofs of the subspaces of W and the corresponding BlockLayout
+
+    Collapsing the subspaces and computing the permutation is done once per
+    mesh and function space; refinement levels and restarts on the same mesh
+    reuse the cached result. Only the layouts of the last four meshes are
+    kept, so a long parameter study does not accumulate them.
+    '''
+    key = (mesh.hash(), W.dim(), lagrange_mult)
+    if key not in _block_layouts:
+        Vdofs = W.sub(0).collapse(mesh)[1].values()
+        Qdofs = W.sub(1).collapse(mesh)[1].values()
+        Ldofs = W.sub(2).collapse(mesh)[1].values() if lagrange_mult else None
+        layout = BlockLayout(Vdofs, Qdofs, Ldofs)
+        _block_layouts[key] = (Vdofs, Qdofs, Ldofs, layout)
+    return _block_layouts[key]
+
+def csr_submatrix(A, rows, cols, col_map=None):
+    '''A[rows,:][:,cols] for a csr matrix A in a single pass
+
+    rows and cols are index arrays or slices (with step 1). col_map maps the
+    columns of A to the columns of the result (-1 for dropped columns); it is
+    computed from cols if not given.
+    '''
+    A = A.tocsr()
+    n, m = A.shape
+    if isinstance(rows, slice):
+        rows = np.arange(*rows.indices(n), dtype=intc)
+    if col_map is None:
+        col_map = -np.ones(m, dtype=intc)
+        if isinstance(cols, slice):
+            start, stop, _ = cols.indices(m)
+            col_map[start:stop] = np.arange(stop-start, dtype=intc)
+        else:
+            col_map[cols] = np.arange(len(cols), dtype=intc)
+        n_cols = (col_map >= 0).sum()
+    else:
+        n_cols = len(cols)
+
+    # gather the rows
+    counts = np.diff(A.indptr)[rows]
+    start = A.indptr[rows]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    src = np.arange(offsets[-1]) + np.repeat(start - offsets[:-1], counts)
+    indices = col_map[A.indices[src]]
+    # drop the columns that are not in cols
+    keep = indices >= 0
+    kept = np.concatenate(([0], np.cumsum(keep)))
+    indptr = kept[offsets]
+    B = csr_matrix((A.data[src][keep], indices[keep], indptr),
+                   shape=(len(rows), n_cols))
+    B.sort_indices()
+    return B
+
+def amg_setup(A, amg_params, seed=1337):
+    '''build a smoothed aggregation hierarchy for A with a fixed random seed'''
+    # pyamg is non-deterministic atm. fix it by setting the random seed
+    # cf. https://code.google.com/p/pyamg/issues/detail?id=139
+    np.random.seed(seed)
+    return smoothed_aggregation_solver(A, **amg_params)
+
+def amg_setup_levels(A, amg_params, seed=1337):
+    '''build a smoothed aggregation hierarchy and return its level matrices
+
+    Returns a list of (A, P, R) for all levels (P and R are None on the
+    coarsest level). In contrast to the multilevel solver itself (its
+    smoothers are closures), the level matrices can be pickled, so this
+    function can be run in a worker process.
+    '''
+    ml = amg_setup(A, amg_params, seed)
+    return [(lvl.A, getattr(lvl, 'P', None), getattr(lvl, 'R', None))
+            for lvl in ml.levels]
+
+def amg_from_levels(levels):
+    '''rebuild the multilevel solver of smoothed_aggregation_solver from level matrices'''
+    lvls = []
+    for A, P, R in levels:
+        lvl = multilevel_solver.level()
+        lvl.A = A
+        if P is not None:
+            lvl.P = P
+            lvl.R = R
+        lvls.append(lvl)
+    ml = multilevel_solver(lvls, coarse_solver='pinv2')
+    # default smoothers of smoothed_aggregation_solver
+    smoother = ('block_gauss_seidel', {'sweep': 'symmetric'})
+    change_smoothers(ml, presmoother=smoother, postsmoother=smoother)
+    return ml
+
+def amg_astype(ml, dtype):
+    '''copy of a multilevel solver with all level matrices converted to dtype'''
+    def astype(M):
+        return M.astype(dtype) if M is not None else None
+    return amg_from_levels([(astype(lvl.A), astype(getattr(lvl, 'P', None)),
+                             astype(getattr(lvl, 'R', None)))
+                            for lvl in ml.levels])
+
+def makedirs(directory):
+    '''create directory (and its parents) unless it exists
+
+    Safe if several processes (e.g. the workers of stokes_eoc2d) create the
+    same directory at the same time.
+    '''
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(directory):
+            raise
+
+class AMGCache(object):
+    '''persistent cache of AMG hierarchies in a directory
+
+    The hierarchies are stored as npz files of their level matrices (see
+    amg_setup_levels), keyed by a sha1 hash of the structure and values of
+    the matrix, the AMG parameters and the random seed. The setup is
+    deterministic, so a hit yields the same hierarchy as a new setup. If the
+    files in the directory exceed max_bytes, the least recently used ones
+    are removed.
+    '''
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        makedirs(directory)
+
+    def key(self, A, amg_params, seed=1337):
+        '''hash of a csr matrix and the AMG setup parameters'''
+        A = A.tocsr()
+        h = hashlib.sha1()
+        h.update(repr((A.shape, sorted(amg_params.items()), seed)).encode())
+        for arr in [A.indptr, A.indices, A.data]:
+            h.update(np.ascontiguousarray(arr).view(np.uint8))
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        '''level matrices for key or None'''
+        fname = self.filename(key)
+        try:
+            data = np.load(fname)
+        except (IOError, OSError):
+            return None
+        levels = []
+        for i in range(int(data['n_levels'])):
+            levels.append(tuple(self._get_csr(data, '%s%d' % (name, i))
+                                for name in ['A', 'P', 'R']))
+        data.close()
+        # mark as recently used (another process may have evicted it meanwhile)
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+        return levels
+
+    def store(self, key, levels):
+        '''store the level matrices under key and evict old entries'''
+        arrays = {'n_levels': len(levels)}
+        for i, mats in enumerate(levels):
+            for name, M in zip(['A', 'P', 'R'], mats):
+                if M is not None:
+                    M = M.tocsr()
+                    prefix = '%s%d_' % (name, i)
+                    arrays[prefix+'data'] = M.data
+                    arrays[prefix+'indices'] = M.indices
+                    arrays[prefix+'indptr'] = M.indptr
+                    arrays[prefix+'shape'] = M.shape
+        # write to a temporary file first, readers never see partial files
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmpname, self.filename(key))
+        self.evict()
+
+    def evict(self):
+        '''remove the least recently used entries until max_bytes is met'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                fname = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fname))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                # removed by another process
+                pass
+            total -= size
+
+    @staticmethod
+    def _get_csr(data, prefix):
+        if prefix+'_data' not in data.files:
+            return None
+        return csr_matrix((data[prefix+'_data'], data[prefix+'_indices'],
+                           data[prefix+'_indptr']), shape=tuple(data[prefix+'_shape']))
+
+class BlockPreconditioner(object):
+    '''block diagonal preconditioner for the Stokes system
+
+    cf. "Fast iterative solvers for discrete Stokes equations",
+    Peters, Reichelt, Reusken 2005
+
+    The AMG hierarchies for the velocity block (mass + dt*laplace), the
+    pressure mass matrix MQ and the pressure laplace matrix NQ are built in
+    setup() and kept until setup() is called again, so the same
+    preconditioner can be applied in many time steps.
+
+    Vdofs, Qdofs and Ldofs are either index arrays or, for matrices and
+    vectors in the numbering of a BlockLayout, the slices of the layout. The
+    blocks of x are then views and no gather is needed in solve().
+
+    With workers > 0 the hierarchies are built concurrently in a pool of
+    worker processes, so the setup takes about as long as the setup for the
+    velocity block alone. Each hierarchy is built with its own fixed seed, so
+    the result does not depend on the number of workers. With an AMGCache,
+    hierarchies of matrices that have been seen before are loaded instead of
+    being set up. Call close() to
+    shut down the pool.
+
+    With dtype=np.float32 the hierarchies are stored and applied in single
+    precision (the setup itself and the cache use double precision). The
+    preconditioner only has to be approximate, so the outer Krylov method in
+    double precision is barely affected, but the V-cycles move half the data.
+    '''
+    amg_params = {'max_levels': 25, 'max_coarse': 50}
+    amgtol = 1e-15
+    amgmaxiter = 3
+
+    def __init__(self, Vdofs, Qdofs, Ldofs, hmin, MQ, NQ, workers=0, cache=None,
+                 dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.workers = workers
+        self._pool = None
+        self.cache = cache
+        self.Vdofs = Vdofs
+        self.Qdofs = Qdofs
+        self.Ldofs = Ldofs
+        self.hmin = hmin
+        # the pressure blocks do not depend on dt
+        self.MQ = csr_submatrix(MQ, Qdofs, Qdofs)
+        self.NQ = csr_submatrix(NQ, Qdofs, Qdofs)
+        self.MQamg = None
+        self.NQamg = None
+        # time step size, time step and system matrix of the last setup
+        self.dt = None
+        self.setup_step = None
+        self.setup_matrix = None
+        self.operator = None
+
+    @property
+    def is_setup(self):
+        return self.operator is not None
+
+    def setup(self, A, dt, step=None):
+        '''build the AMG hierarchies
+
+        The velocity block is taken from the system matrix A = mass + dt*stiffness
+        (with eliminated boundary conditions). The hierarchies of the pressure
+        blocks only depend on the mesh and are built in the first setup only.
+        '''
+        MV = csr_submatrix(A, self.Vdofs, self.Vdofs)
+
+#        solver_diagnostics(MV,
+#               fname='solver_diagnostic_MV',
+#               definiteness='positive',
+#               symmetry='hermitian'
+#               )
+#        solver_diagnostics(self.MQ,
+#               fname='solver_diagnostic_MQ',
+#               definiteness='positive',
+#               symmetry='hermitian'
+#               )
+#        solver_diagnostics(self.NQ,
+#               fname='solver_diagnostic_NQ',
+#               definiteness='positive',
+#               symmetry='hermitian'
+#               )
+
+        if self.MQamg is None:
+            mls = self._amg_setup([MV, self.MQ, self.NQ])
+        else:
+            mls = self._amg_setup([MV])
+        if self.dtype != np.float64:
+            mls = [amg_astype(ml, self.dtype) for ml in mls]
+        if self.MQamg is None:
+            self.MVamg, self.MQamg, self.NQamg = mls
+        else:
+            self.MVamg, = mls
+        self.dt = dt
+        self.setup_step = step
+        self.setup_matrix = A
+        self.operator = LinearOperator(A.shape, self.solve)
+
+    def _amg_setup(self, matrices):
+        '''build the AMG hierarchies for a list of matrices'''
+        if self.cache is not None:
+            return self._amg_setup_cached(matrices)
+        if not self.workers or len(matrices) == 1:
+            return [amg_setup(B, self.amg_params) for B in matrices]
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers)
+        results = [self._pool.apply_async(amg_setup_levels, (B, self.amg_params))
+                   for B in matrices]
+        return [amg_from_levels(r.get()) for r in results]
+
+    def _amg_setup_cached(self, matrices):
+        '''load the AMG hierarchies from the cache, set up the missing ones'''
+        cache = self.cache
+        keys = [cache.key(B, self.amg_params) for B in matrices]
+        mls = [None]*len(matrices)
+        missing = []
+        for i, key in enumerate(keys):
+            levels = cache.load(key)
+            if levels is None:
+                missing.append(i)
+            else:
+                mls[i] = amg_from_levels(levels)
+        if not self.workers or len(missing) <= 1:
+            for i in missing:
+                mls[i] = amg_setup(matrices[i], self.amg_params)
+                cache.store(keys[i], [(lvl.A, getattr(lvl, 'P', None), getattr(lvl, 'R', None))
+                                      for lvl in mls[i].levels])
+        else:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.workers)
+            results = [(i, self._pool.apply_async(amg_setup_levels, (matrices[i], self.amg_params)))
+                       for i in missing]
+            for i, r in results:
+                levels = r.get()
+                cache.store(keys[i], levels)
+                mls[i] = amg_from_levels(levels)
+        return mls
+
+    def close(self):
+        '''shut down the worker pool'''
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def solve(self, x, out=None):
+        '''apply the preconditioner to x
+
+        The result is written to out (allocated if None). Every dof belongs to
+        exactly one block, so out does not need to be initialized.
+        '''
+        dt = self.dt
+        hmin = self.hmin
+        amgtol = self.amgtol
+        amgmaxiter = self.amgmaxiter
+        if out is None:
+            out = np.empty(x.shape)
+        xV = x[self.Vdofs]
+        xQ = x[self.Qdofs]
+        if self.dtype != np.float64:
+            # the results are converted back when they are written to out
+            xV = xV.astype(self.dtype)
+            xQ = xQ.astype(self.dtype)
+        out[self.Vdofs] = self.MVamg.solve(xV, maxiter=amgmaxiter, tol=amgtol).reshape(xV.shape)
+        if hmin**2 <= dt:
+            out[self.Qdofs] =           self.MQamg.solve(xQ, maxiter=amgmaxiter, tol=amgtol).reshape(xQ.shape) \
+                            + (1/dt)   *self.NQamg.solve(xQ, maxiter=amgmaxiter, tol=amgtol).reshape(xQ.shape)
+        else:
+            out[self.Qdofs] = (hmin**2/dt)*self.MQamg.solve(xQ, maxiter=amgmaxiter, tol=amgtol).reshape(xQ.shape) \
+                            + (1/dt)   *self.NQamg.solve(xQ, maxiter=amgmaxiter, tol=amgtol).reshape(xQ.shape)
+        if self.Ldofs is not None:
+            out[self.Ldofs] = x[self.Ldofs]
+        return out
+
+class PrecRefreshPolicy(object):
+    '''decides when a BlockPreconditioner has to be rebuilt
+
+    every          -- rebuild every `every` time steps (None: never)
+    on_dt_change   -- rebuild if dt differs from the dt of the last setup
+    max_iterations -- rebuild if the last GMRES run needed more than
+                      max_iterations iterations more than the first run
+                      after the last setup
+
+    The preconditioner is always built if it has not been set up yet. With
+    the defaults it is built once and kept for the whole run if dt is fixed.
+    A rebuild for the same system matrix and dt as the last setup would give
+    the same hierarchies (the AMG setup is seeded), so it is skipped.
+    '''
+    def __init__(self, every=None, on_dt_change=True, max_iterations=None):
+        self.every = every
+        self.on_dt_change = on_dt_change
+        self.max_iterations = max_iterations
+        # iterations of the first run after the last setup
+        self._base_iterations = None
+        self._after_setup = False
+
+    def needs_refresh(self, prec, step, dt, iterations=None, A=None):
+        if self._after_setup:
+            self._base_iterations = iterations
+            self._after_setup = False
+        refresh = self._needs_refresh(prec, step, dt, iterations, A)
+        if refresh:
+            self._after_setup = True
+        return refresh
+
+    def _needs_refresh(self, prec, step, dt, iterations, A):
+        if not prec.is_setup:
+            return True
+        if A is not None and A is prec.setup_matrix and dt == prec.dt:
+            return False
+        if self.every is not None and step - prec.setup_step >= self.every:
+            return True
+        if self.on_dt_change and dt != prec.dt:
+            return True
+        if self.max_iterations is not None and iterations is not None \
+                and self._base_iterations is not None \
+                and iterations > self._base_iterations + self.max_iterations:
+            return True
+        return False
+
+class RecyclingStrategy(object):
+    '''decides how and when the deflation space of StokesLinearSolver is updated
+
+    n_defl        -- number of deflation vectors
+    which         -- "ritz": Ritz vectors from krypy's utils.ritzh
+                     "harmonic": harmonic Ritz vectors of the preconditioned
+                     operator on the space spanned by the old deflation
+                     vectors and the Krylov basis
+    every         -- update the deflation space every `every` time steps (the
+                     space is kept in between, so the Krylov basis is not
+                     needed in these steps)
+    auto_disable  -- switch deflation off if the measured savings in GMRES
+                     time do not cover its cost (Ritz vectors, A*Z and
+                     projections), judged after `samples` deflated solves
+    probe_every   -- with auto_disable, every probe_every-th solve is a probe
+                     without deflation (the deflation space is kept)
+
+    The savings are estimated from the iterations of the probes and the
+    measured time per iteration. The probes are warm-started like the
+    deflated solves. The first solve is a cold start and is not used for the
+    comparison.
+    '''
+    def __init__(self, n_defl, which="ritz", every=1, auto_disable=True, samples=3,
+                 probe_every=10):
+        if which not in ["ritz", "harmonic"]:
+            raise ValueError("Ritz selection '%s' unknown." % which)
+        self.n_defl = n_defl
+        self.which = which
+        self.every = every
+        self.auto_disable = auto_disable
+        self.samples = samples
+        self.probe_every = probe_every
+        self.enabled = n_defl > 0
+        self.last_update = None
+        # number of solves so far and whether the current one is a probe
+        self._solves = 0
+        self.probe = False
+        # (iterations, gmres time) without deflation
+        self._plain = []
+        # (iterations, gmres time, overhead) with deflation
+        self._deflated = []
+
+    def use_deflation(self):
+        '''should the next solve be deflated? (called once per solve)'''
+        solve = self._solves
+        self._solves += 1
+        # solve 0 is the cold start, solve 1 the first probe
+        self.probe = self.enabled and self.auto_disable and (solve == 1 or
+                (self.probe_every and solve > 1 and solve % self.probe_every == 0))
+        return self.enabled and not self.probe
+
+    def wants_update(self, step):
+        '''should the Ritz vectors be computed after this solve?'''
+        if not self.enabled or self.probe:
+            return False
+        if step is None or self.last_update is None:
+            return True
+        return step - self.last_update >= self.every
+
+    def update(self, itsol, Z, AZ, A, Prec, step, Proj=None):
+        '''new deflation vectors from the Krylov basis of itsol
+
+        Proj is the deflation projection the GMRES run was done with (None
+        without deflation).
+        '''
+        self.last_update = step
+        Vfull = itsol['Vfull']
+        V = Vfull[:,0:-1]
+        if self.which == "ritz":
+            ritz_vals, ritz_coeffs, ritz_res_norm = utils.ritzh(Vfull, itsol['Hfull'], Z, AZ, A, M=Prec)
+            selection = np.argsort(abs(ritz_vals))[:self.n_defl]
+            nZ = Z.shape[1]
+            return np.dot(Z, ritz_coeffs[0:nZ, selection]) \
+                 + np.dot(V, ritz_coeffs[nZ:,selection])
+        # harmonic Ritz pairs (theta, S y) of the preconditioned operator
+        # M*A on S = [Z, V]: (M*A*S)^T (M*A*S) y = theta (M*A*S)^T S y.
+        # No products with A are needed: with the Arnoldi relation
+        # M*A*Proj*V = Vfull*Hfull and (I - Proj)*V = Z*C,
+        #   M*A*S = [M*AZ, Vfull*Hfull + M*AZ*C] = X*T1 and S = X*T2
+        # for X = [M*AZ, Vfull, Z], so only the Gram matrix of X is formed.
+        Vfull = np.asarray(Vfull)
+        V = Vfull[:,0:-1]
+        H = np.asarray(itsol['Hfull'])
+        nZ = Z.shape[1]
+        n = V.shape[1]
+        if nZ > 0:
+            MAZ = Prec*AZ if Prec is not None else AZ
+            D = V - Proj*V if Proj is not None else np.zeros_like(V)
+            C = np.linalg.lstsq(Z, D, rcond=-1)[0]
+        else:
+            MAZ = Z
+            C = np.zeros((0, n))
+        X = np.column_stack([MAZ, Vfull, Z])
+        G = np.dot(X.T, X)
+        T1 = np.zeros((X.shape[1], nZ+n))
+        T1[:nZ,:nZ] = np.eye(nZ)
+        T1[:nZ,nZ:] = C
+        T1[nZ:nZ+n+1,nZ:] = H
+        T2 = np.zeros((X.shape[1], nZ+n))
+        T2[nZ+n+1:,:nZ] = np.eye(nZ)
+        T2[nZ:nZ+n,nZ:] = np.eye(n)
+        GT1 = np.dot(G, T1)
+        theta, Y = scipy.linalg.eig(np.dot(T1.T, GT1), np.dot(GT1.T, T2))
+        finite = np.isfinite(theta)
+        selection = np.argsort(abs(theta[finite]))[:self.n_defl]
+        Y = np.real(Y[:,finite][:,selection])
+        Znew = np.dot(Z, Y[:nZ]) + np.dot(V, Y[nZ:])
+        Znew, _ = np.linalg.qr(Znew)
+        return Znew
+
+    def record(self, iterations, gmres_time, overhead, deflated):
+        '''record the cost of a solve, disable deflation if it does not pay off'''
+        if self._solves <= 1:
+            # cold start, its iterations are not comparable
+            return
+        if not deflated:
+            self._plain.append((iterations, gmres_time))
+            return
+        self._deflated.append((iterations, gmres_time, overhead))
+        if not self.auto_disable or not self._plain or len(self._deflated) < self.samples:
+            return
+        plain_its = np.mean([its for its, _ in self._plain[-self.samples:]])
+        its = np.array([d[0] for d in self._deflated[-self.samples:]], dtype=float)
+        times = np.array([d[1] for d in self._deflated[-self.samples:]])
+        overheads = np.array([d[2] for d in self._deflated[-self.samples:]])
+        time_per_it = times.sum()/max(its.sum(), 1.)
+        savings = (plain_its - its.mean())*time_per_it
+        if savings < overheads.mean():
+            self.enabled = False
+            print('Deflation disabled: saves %e s per solve but costs %e s.' % (savings, overheads.mean()))
+
+def get_lirk_stepper(scheme, n):
+    '''LIRKStepper for numpy vectors of size n'''
+    def vecsrc(k):
+        return [np.zeros(n) for i in range(k)]
+    def veccpy(a, b):
+        b[:] = a
+    def zero(a):
+        a[:] = 0
+    def axpy(x, a, y):
+        x += a*y
+    return lirk.LIRKStepper(scheme, vecsrc, veccpy, zero, axpy)
+
+class SolveStats(object):
+    '''timings and solver statistics of each step of solve_stokes
+
+    The time spent in each phase (e.g. 'rhs_assembly', 'gmres', 'output') is
+    accumulated per step with the phase() context manager. The iteration
+    counts and residual histories of all linear solves of the step are
+    recorded with record_solve(). Finished steps are kept in self.steps and,
+    if a stream (a file name or file object) is given, written to it as
+    JSON lines (a file name is appended to with append=True, e.g. by a
+    restarted run). Outside of begin_step() and end_step() nothing is
+    recorded.
+    '''
+    def __init__(self, stream=None, append=False):
+        self.steps = []
+        self.current = None
+        if isinstance(stream, str):
+            stream = open(stream, 'a' if append else 'w')
+        self.stream = stream
+
+    def begin_step(self, step, t):
+        self.current = {'step': step, 't': t, 'times': {},
+                        'iterations': [], 'residuals': []}
+
+    @contextmanager
+    def phase(self, name):
+        start = timer()
+        try:
+            yield
+        finally:
+            if self.current is not None:
+                times = self.current['times']
+                times[name] = times.get(name, 0.) + timer() - start
+
+    def record_solve(self, iterations, residuals=None):
+        if self.current is not None:
+            self.current['iterations'].append(iterations)
+            if residuals is not None:
+                self.current['residuals'].append([float(r) for r in residuals])
+
+    def end_step(self):
+        record = self.current
+        self.current = None
+        if record is None:
+            return
+        self.steps.append(record)
+        if self.stream is not None:
+            self.stream.write(json.dumps(record) + '\n')
+            self.stream.flush()
+
+    def totals(self):
+        '''total time of each phase over all steps'''
+        totals = {}
+        for record in self.steps:
+            for name, time in record['times'].items():
+                totals[name] = totals.get(name, 0.) + time
+        return totals
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+class Predictor(object):
+    '''initial guesses from the solutions of the last steps
+
+    The last k solutions are kept in a ring buffer. predict() returns
+      "extrapolation" -- the polynomial through them (of degree k-1 in t)
+                         evaluated at t
+      "projection"    -- the element x of their span with minimal residual
+                         |b - A x|
+    '''
+    def __init__(self, k=3, method="extrapolation"):
+        if method not in ["extrapolation", "projection"]:
+            raise ValueError("Predictor method '%s' unknown." % method)
+        self.method = method
+        self.history = collections.deque(maxlen=k)
+
+    def __len__(self):
+        return len(self.history)
+
+    def push(self, t, x):
+        self.history.append((t, np.array(x).reshape(-1)))
+
+    def predict(self, t, A=None, b=None):
+        times = [tk for tk, _ in self.history]
+        X = np.column_stack([xk for _, xk in self.history])
+        if self.method == "projection":
+            AX = A*X
+            coeffs = np.linalg.lstsq(AX, np.asarray(b).reshape(-1), rcond=-1)[0]
+        else:
+            # Lagrange basis polynomials at t
+            coeffs = np.ones(len(times))
+            for i, ti in enumerate(times):
+                for j, tj in enumerate(times):
+                    if i != j:
+                        coeffs[i] *= (t - tj)/(ti - tj)
+        return np.dot(X, coeffs)
+
+def krylov_memory(n_dofs, restart, n_defl=0):
+    '''estimated peak memory of a (restarted) GMRES solve in bytes
+
+    Counts the Krylov basis (restart+1 vectors), the Hessenberg matrix, the
+    deflation vectors Z and AZ, the n_defl new Ritz vectors and a few work
+    vectors (b, x0, x, residual, preconditioned vector), all in double
+    precision. The matrix and the preconditioner are not included.
+    '''
+    vectors = (restart+1) + 3*n_defl + 5
+    return 8*(vectors*n_dofs + (restart+1)*restart)
+
+class StokesLinearSolver(object):
+    '''solver for the linear systems (mass + fac*stiffness) x = b of solve_stokes
+
+    linsolver is one of
+      "krypy"               -- krypy's GMRES, preconditioned with a BlockPreconditioner
+                               and optionally deflated with n_defl Ritz vectors
+      "minres"              -- krypy's MINRES with the same (symmetric positive definite)
+                               BlockPreconditioner, memory independent of the iterations
+      "direct"              -- sparse LU factorization of the csr matrix with scipy
+                               (UMFPACK if scikits.umfpack is installed, SuperLU otherwise)
+      "petsc", "lu", "gmres" -- dolfin's LinearSolver
+
+    The right hand side b is given without boundary conditions, the values g
+    of the Dirichlet dofs are imposed by the solver. The preconditioner, the
+    dolfin solver (with its factorization) and the deflation space are kept
+    between calls, so all systems with the same fac (all time steps, all
+    stages of a LIRK method) share them. With "direct", every step (and every
+    stage) is a pair of triangular solves once the matrix is factorized.
+
+    With restart, GMRES is restarted every restart iterations, so its basis
+    has at most restart+1 vectors and the memory is bounded independently of
+    maxiter (see krylov_memory()). The deflation vectors are then Ritz
+    vectors of the last cycle. Without deflation (n_defl=0) the basis is
+    not kept at all.
+
+    How the deflation space is updated (Ritz or harmonic Ritz vectors, how
+    often, whether it is switched off when it does not pay off) is decided
+    by a RecyclingStrategy, by default RecyclingStrategy(n_defl).
+
+    With a Predictor, the initial guesses of the csr solvers for solves with
+    a time t are predicted from the solutions of the last calls (boundary
+    values are imposed afterwards).
+
+    If a BlockLayout is given, the csr solvers work in the block numbering
+    (the preconditioner has to be set up with the slices of the layout).
+    Only the right hand side, the initial guess and the solution are
+    permuted, once per solve.
+    '''
+    def __init__(self, operator, prec, linsolver="krypy", prec_refresh=None,
+                 n_defl=0, tol=1e-6, maxiter=150, layout=None, stats=None,
+                 predictor=None, restart=None, recycling=None):
+        if linsolver not in ["krypy", "minres", "direct", "petsc", "lu", "gmres"]:
+            raise RuntimeError("Linear solver '%s' unknown." % linsolver)
+        if linsolver == "minres" and (n_defl > 0 or recycling is not None):
+            raise RuntimeError("Deflation is not available with MINRES.")
+        self.operator = operator
+        self.prec = prec
+        self.linsolver = linsolver
+        if prec_refresh is None:
+            prec_refresh = PrecRefreshPolicy()
+        self.prec_refresh = prec_refresh
+        if recycling is None and n_defl > 0:
+            recycling = RecyclingStrategy(n_defl)
+        self.recycling = recycling
+        self.n_defl = recycling.n_defl if recycling is not None else 0
+        self.tol = tol
+        self.maxiter = maxiter
+        self.restart = restart
+        self.layout = layout
+        self.predictor = predictor
+        self.stats = stats if stats is not None else SolveStats()
+        # system matrices in the block numbering
+        self._systems = LRUCache()
+        self._systems_operator = None
+
+        n_dofs = operator.mass.size(0)
+        self.n_dofs = n_dofs
+        # deflation vectors
+        self.Z = np.zeros( (n_dofs,0) )
+        self.AZ = np.zeros( (n_dofs,0) )
+        # (A, Z) that AZ belongs to
+        self._AZ_for = (None, None)
+        # iterations of the last solve
+        self.iterations = None
+        self._dolfin_solver = None
+        self._dolfin_fac = None
+        self._dolfin_operator = None
+        # LU factorizations of operator.system(fac) for the last values of fac
+        self._factorizations = LRUCache()
+        self._factorized_operator = None
+
+    def solve(self, fac, b, g, x0=None, step=None, t=None):
+        '''solve (mass + fac*stiffness) x = b with x[bc_dofs] = g
+
+        x0 is the initial guess for the iterative solver, step the current time
+        step (for the refresh policy of the preconditioner). If t is given and
+        the solver has a predictor, the initial guess is predicted instead.
+        '''
+        n_dofs = self.n_dofs
+        operator = self.operator
+        stats = self.stats
+        if self.linsolver in ["petsc", "lu", "gmres"]:
+            if self._dolfin_solver is None or self._dolfin_fac != fac \
+                    or self._dolfin_operator is not operator:
+                self._dolfin_solver = LinearSolver(self.linsolver)
+                self._dolfin_solver.parameters["lu_solver"]["reuse_factorization"] = True
+                with stats.phase('matrix_assembly'):
+                    A = operator.matrix(fac)
+                self._dolfin_solver.set_operator(A)
+                self._dolfin_fac = fac
+                self._dolfin_operator = operator
+            bvec = Vector(n_dofs)
+            b = np.array(b, dtype=float).reshape(n_dofs)
+            b[operator.bc_dofs] = g
+            bvec.set_local(b)
+            xvec = Vector(n_dofs)
+            with stats.phase('linear_solve'):
+                self._dolfin_solver.solve(xvec, bvec)
+            stats.record_solve(None)
+            return xvec.array()
+
+        with stats.phase('matrix_assembly'):
+            A = self.system(fac)
+        b = np.array(b, dtype=float).reshape((n_dofs,1))
+        with stats.phase('bcs'):
+            operator.apply_bcs(b, fac, g)
+
+        # use initial guess that satisfies boundary conditions
+        if x0 is None:
+            x0 = np.zeros((n_dofs,1))
+        else:
+            x0 = np.array(x0, dtype=float).reshape((n_dofs,1))
+        x0[operator.bc_dofs] = g.reshape(x0[operator.bc_dofs].shape)
+
+        layout = self.layout
+        if layout is not None:
+            b = layout.to_blocks(b)
+            x0 = layout.to_blocks(x0)
+
+        predictor = self.predictor
+        if predictor is not None and t is not None and len(predictor) > 0:
+            with stats.phase('prediction'):
+                bc_rows = operator.bc_dofs if layout is None else layout.iperm[operator.bc_dofs]
+                x0 = predictor.predict(t, A, b).reshape((n_dofs,1))
+                x0[bc_rows] = g.reshape(x0[bc_rows].shape)
+
+        x = self._solve_csr(A, fac, b, x0, step)
+        if predictor is not None and t is not None:
+            predictor.push(t, x)
+        if layout is not None:
+            x = layout.from_blocks(x)
+        return x
+
+    def system(self, fac):
+        '''system matrix for fac in the numbering of the solver'''
+        if self.layout is None:
+            return self.operator.system(fac)
+        if self._systems_operator is not self.operator:
+            self._systems = LRUCache()
+            self._systems_operator = self.operator
+        if fac not in self._systems:
+            self._systems[fac] = self.layout.matrix(self.operator.system(fac))
+        return self._systems[fac]
+
+    def _solve_csr(self, A, fac, b, x0, step):
+        '''solve A x = b for a csr matrix with applied boundary conditions'''
+        n_dofs = self.n_dofs
+        operator = self.operator
+        stats = self.stats
+        if self.linsolver == "direct":
+            if self._factorized_operator is not operator:
+                self._factorizations = LRUCache()
+                self._factorized_operator = operator
+            if fac not in self._factorizations:
+                with stats.phase('factorization'):
+                    self._factorizations[fac] = factorized(A.tocsc())
+                print('Factorized system matrix in step %s.' % step)
+            self.iterations = 0
+            with stats.phase('linear_solve'):
+                x = self._factorizations[fac](b.reshape(n_dofs))
+            stats.record_solve(0)
+            return x
+
+        # build preconditioner (or reuse it if the policy allows)
+        prec = self.prec
+        if self.prec_refresh.needs_refresh(prec, step, fac, self.iterations, A):
+            with stats.phase('prec_setup'):
+                prec.setup(A, fac, step)
+            print('Preconditioner set up in step %s.' % step)
+        Prec = prec.operator
+
+        if self.linsolver == "minres":
+            # the system matrix is symmetric (the boundary conditions are
+            # eliminated symmetrically) and so is the preconditioner
+            with stats.phase('minres'):
+                itsol = linsys.minres(A, b, x0=x0, tol=self.tol, maxiter=self.maxiter, M=Prec)
+            self.iterations = len(itsol["relresvec"])-1
+            stats.record_solve(self.iterations, itsol["relresvec"])
+            print("MINRES performed %d iterations with final res %e." % (self.iterations, itsol["relresvec"][-1]) )
+            return np.asarray(itsol["xk"]).reshape(n_dofs)
+
+        # prepare deflation vectors, A*Z is reused while A and Z are unchanged
+        recycling = self.recycling
+        Z = self.Z
+        AZ = self.AZ
+        overhead = 0.
+        # in a probe the deflation space is not used but kept
+        probe = False
+        if recycling is not None and not recycling.use_deflation():
+            probe = recycling.probe
+            Z = np.zeros( (n_dofs,0) )
+        deflated = Z.shape[1] > 0
+        if not deflated:
+            AZ = np.zeros( (n_dofs,0) )
+        if deflated and not (self._AZ_for[0] is A and self._AZ_for[1] is Z):
+            start = timer()
+            with stats.phase('deflation'):
+                AZ = A*Z
+            overhead += timer() - start
+            self._AZ_for = (A, Z)
+
+        # GMRES, restarted every self.restart iterations. The Krylov basis is
+        # only kept if it is needed for the Ritz vectors of the deflation.
+        return_basis = recycling is not None and recycling.wants_update(step)
+        x = x0
+        relresvec = []
+        gmres_time = 0.
+        while True:
+            Proj = None
+            if deflated:
+                start = timer()
+                with stats.phase('deflation'):
+                    Proj, x = utils.get_projection(b, Z, AZ, x)
+                overhead += timer() - start
+            maxiter = self.maxiter - max(len(relresvec)-1, 0)
+            if self.restart is not None:
+                maxiter = min(maxiter, self.restart)
+            start = timer()
+            with stats.phase('gmres'):
+                itsol = linsys.gmres(A, b, x0=x, tol=self.tol, maxiter=maxiter, Mr=Proj, M=Prec,
+                                     return_basis = return_basis)
+            gmres_time += timer() - start
+            x = itsol["xk"]
+            cycle_relresvec = list(itsol["relresvec"])
+            relresvec += cycle_relresvec[1:] if relresvec else cycle_relresvec
+            if self.restart is None or cycle_relresvec[-1] <= self.tol \
+                    or len(relresvec)-1 >= self.maxiter:
+                break
+
+        self.iterations = len(relresvec)-1
+        stats.record_solve(self.iterations, relresvec)
+        print("GMRES performed %d iterations with final res %e." % (self.iterations, relresvec[-1]) )
+
+        # extract deflation data
+        if recycling is None:
+            Z = np.zeros( (n_dofs,0) )
+            AZ = np.zeros( (n_dofs,0) )
+        else:
+            if return_basis and ('Vfull' in itsol) and ('Hfull' in itsol):
+                start = timer()
+                with stats.phase('deflation'):
+                    Z = recycling.update(itsol, Z, AZ, A, Prec, step, Proj)
+                overhead += timer() - start
+            recycling.record(self.iterations, gmres_time, overhead, deflated)
+        if not probe:
+            self.Z = Z
+            self.AZ = AZ
+
+        return np.asarray(x).reshape(n_dofs)
+
+    def memory_estimate(self):
+        '''estimated peak memory of a krypy solve in bytes (see krylov_memory)'''
+        if self.linsolver == "minres":
+            # short recurrences: a fixed number of vectors
+            return 8*10*self.n_dofs
+        return krylov_memory(self.n_dofs, self.restart or self.maxiter, self.n_defl)
+
+class AsyncWriter(object):
+    '''writes snapshots to dolfin Files in a background thread
+
+    Functions are copied when they are enqueued, so the solver can go on
+    with the next step while the snapshot is written. Subfunctions of a
+    mixed Function cannot be copied, split(deepcopy=True) gives copies that
+    are enqueued with copy=False. The queue holds at
+    most maxsize snapshots; put() blocks if the writer falls behind.
+
+    Outputs are written every `every` steps and, if every_t is given, only
+    at least every_t apart in time (see due()).
+    '''
+    def __init__(self, maxsize=4, every=1, every_t=None):
+        self.every = every
+        self.every_t = every_t
+        self._next_t = None
+        self._queue = queue.Queue(maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def due(self, step, t):
+        '''is output due in step at time t?'''
+        if self.every and step % self.every != 0:
+            return False
+        if self.every_t is not None:
+            if self._next_t is not None and t < self._next_t - 1e-12*max(1., abs(t)):
+                return False
+            self._next_t = t + self.every_t
+        return True
+
+    def put(self, f, func, t=None, copy=True):
+        '''enqueue func for f << (func, t)'''
+        if self._error is not None:
+            raise self._error
+        if f is None:
+            return
+        if copy:
+            func = func.copy(deepcopy=True)
+        self._queue.put((f, func, t))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            f, func, t = item
+            try:
+                if t is None:
+                    f << func
+                else:
+                    f << (func, t)
+            except Exception as e:
+                self._error = e
+
+    def close(self):
+        '''write all pending snapshots and stop the thread'''
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+class Checkpointer(object):
+    '''periodic checkpoints of the state of the time loop of solve_stokes
+
+    Every `every` steps the state (a dict of arrays and scalars) is written
+    to an npz file in directory. A checkpoint is written to a temporary file
+    and renamed afterwards, so a killed run leaves either the old or the new
+    checkpoint but never a partial one. Only the last `keep` checkpoints are
+    kept. When a run finishes, clear() removes its checkpoints, so only an
+    interrupted run can be resumed.
+    '''
+    def __init__(self, directory, every=10, keep=2):
+        self.directory = directory
+        self.every = every
+        self.keep = keep
+        makedirs(directory)
+
+    def due(self, step):
+        return self.every and step % self.every == 0
+
+    def files(self):
+        '''checkpoint files, oldest first'''
+        return sorted(os.path.join(self.directory, name)
+                      for name in os.listdir(self.directory)
+                      if name.startswith('checkpoint_') and name.endswith('.npz'))
+
+    def save(self, step, state):
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **state)
+        os.rename(tmpname, os.path.join(self.directory, 'checkpoint_%08d.npz' % step))
+        for fname in self.files()[:-self.keep]:
+            os.remove(fname)
+
+    def clear(self):
+        '''remove all checkpoints'''
+        for fname in self.files():
+            os.remove(fname)
+
+    def latest(self):
+        '''state of the latest checkpoint or None'''
+        files = self.files()
+        if not files:
+            return None
+        with np.load(files[-1]) as data:
+            return dict((key, data[key]) for key in data.files)
+
+def prolong(history, t, W):
+    '''interpolate a solution history [(t_k, w_k), ...] at time t into W
+
+    The w_k are Functions on a mixed space of the same structure as W,
+    usually on a coarser mesh. Between two t_k the history is interpolated
+    linearly in time, outside it is extended by its first or last entry.
+    '''
+    times = [tk for tk, _ in history]
+    k = bisect.bisect_left(times, t)
+    if k == 0:
+        w = history[0][1]
+    elif k == len(times):
+        w = history[-1][1]
+    else:
+        (t0, w0), (t1, w1) = history[k-1], history[k]
+        theta = (t - t0)/(t1 - t0)
+        w = Function(w0.function_space())
+        w.vector().axpy(1-theta, w0.vector())
+        w.vector().axpy(theta, w1.vector())
+    # the boundary of the fine mesh may lie slightly outside the coarse one
+    w.set_allow_extrapolation(True)
+    return interpolate(w, W)
+
 def solve_stokes(mesh,
                  u_init = Constant(0.),
                  f = Constant(0.),
@@ -193,6 +1591,25 @@ def solve_stokes(mesh,
                  linsolver = "krypy",
                  linsolver_params = {},
                  n_defl = 0,
+                 recycling = None, # RecyclingStrategy for the deflation space, default: from n_defl
+                 reuse_operator = True, # assemble the mass and stiffness matrices only once
+                 prec_refresh = None, # PrecRefreshPolicy, default: build once per dt
+                 prec_workers = 0, # worker processes for the AMG setup
+                 prec_cache = None, # directory (or AMGCache) for AMG hierarchies
+                 prec_dtype = np.float64, # precision of the AMG hierarchies (np.float32: single)
+                 block_layout = True, # renumber dofs blockwise for the csr solvers
+                 time_integrator = None, # LIRK method (or its name), default: implicit Euler
+                 keep_history = False, # return the solution in every step (and Z) as Functions on W
+                 initial_guess = None, # history of a (coarser) solution, see prolong() (krypy, minres)
+                 initial_deflation = None, # Functions (on a coarser W) for the initial deflation space
+                 predictor = None, # Predictor for the initial guesses of implicit Euler
+                 output_every = 1, # write every output_every steps
+                 output_dt = None, # and/or only at least output_dt apart
+                 output_queue = 4, # max. number of snapshots in the writer queue
+                 checkpoint = None, # directory (or Checkpointer) for checkpoints of the time loop
+                 restart = False, # resume from the latest checkpoint (continues stats_file and snapshots)
+                 stats_file = None, # stream the per step statistics as JSON lines
+                 snapshots = None, # path of a snapshot store (see snapshots.py) for u and p
                  u_file = None,
                  p_file = None,
                  u_err_file = None,
@@ -244,12 +1661,8 @@ def solve_stokes(mesh,
     w = Function(W)
 
     # get dof mappings of subspaces
-    Vdofs = W.sub(0).collapse(mesh)[1].values()
-    Qdofs = W.sub(1).collapse(mesh)[1].values()
-    n_dofs = len(Vdofs) + len(Qdofs)
-    if lagrange_mult:
-        Ldofs = W.sub(2).collapse(mesh)[1].values()
-        n_dofs += len(Ldofs)
+    Vdofs, Qdofs, Ldofs, layout = get_block_layout(mesh, W, lagrange_mult)
+    n_dofs = W.dim()
 
     t = t0
     set_time(expressions, t)
@@ -258,204 +1671,309 @@ def solve_stokes(mesh,
     print('Solve with n_dofs=%d, dt=%e, hmin/hmax=%e.'
             % (n_dofs, dt, mesh.hmin()/mesh.hmax()))
 
+    # the state of a restart is read before any output is opened, the
+    # output of the interrupted run is continued instead of overwritten
+    if isinstance(checkpoint, str):
+        checkpoint = Checkpointer(checkpoint)
+    state = None
+    if restart and checkpoint is not None:
+        state = checkpoint.latest()
+        if state is not None and (len(state['w0']) != n_dofs or float(state['dt']) != dt):
+            raise ValueError('Checkpoint does not match the problem (n_dofs or dt differ).')
+
     # Initial value
     u_old = Function(V)
     u_old.interpolate(u_init)
-    if u_file is not None:
-        u_file << u_old
-    if p_file is not None:
-        pass
-        #TODO
-        #p_file << ???
-
-    # for initial vector of iterative method
-    w0 = Function(W)
-    w0.vector().zero()
-
-    # deflation vectors
-    Z = np.zeros( (n_dofs,0) )
-    AZ = np.zeros( (n_dofs,0) )
-    Proj = None
-
-    # Define variational problem
-    if lagrange_mult:
-        (u, p, lam) = TrialFunctions(W)
-        (v, q, l) = TestFunctions(W)
-    else:
-        (u, p) = TrialFunctions(W)
-        (v, q) = TestFunctions(W)
-    ds = Measure('ds')[boundaries]
-    
-    dbc = [DirichletBC(W.sub(0), bc, boundaries, tag) for tag, bc in dbcs.items()]
-    Avar = inner(u,v)*dx + dt*(inner(grad(u), grad(v))*dx - div(v)*p*dx - q*div(u)*dx)
-    if lagrange_mult:
-        Avar += dt*(lam*q*dx + p*l*dx)
+    # the outputs are closed in the finally clause, also on errors
+    writer = None
+    snapshot_store = None
+    stats = None
+    prec = None
+    try:
+        # files are written in a background thread
+        writer = AsyncWriter(output_queue, output_every, output_dt)
+        writer.due(0, t)
+        if state is None:
+            writer.put(u_file, u_old, t)
+        # raw dof vectors of u and p in a single store
+        if snapshots is not None:
+            Vdofs_arr = np.asarray(list(Vdofs), dtype=intc)
+            Qdofs_arr = np.asarray(list(Qdofs), dtype=intc)
+            snapshot_store = SnapshotWriter(snapshots,
+                                            {'u': len(Vdofs_arr), 'p': len(Qdofs_arr)},
+                                            mesh={'coordinates': mesh.coordinates(), 'cells': mesh.cells()},
+                                            dofmaps={'u': Vdofs_arr, 'p': Qdofs_arr},
+                                            append=state is not None)
+            if state is not None:
+                # steps after the checkpoint are computed again
+                snapshot_store.truncate(float(state['t']))
+        if p_file is not None:
+            pass
+            #TODO
+            #p_file << ???
 
-    # variational problem for preconditioner
-    Mvar = inner(u,v)*dx + dt*inner(grad(u), grad(v))*dx + p*q*dx
-    if lagrange_mult:
-        Mvar += lam*l*dx
-    Nvar = inner(grad(p),grad(q))*dx
-    Mprec = None
+        # for initial vector of iterative method
+        w0 = Function(W)
+        w0.vector().zero()
 
-    if u_ex is not None:
-        u_err_norms = []
-    if p_ex is not None:
-        p_err_norms = []
-    while t<tend:
-        t += dt
-        set_time(expressions, t)
-        print(t)
-
-        # update right hand side for implicit Euler
-        bvar = inner(u_old,v)*dx + dt*inner(f, v)*dx
-        if p_ex is not None and lagrange_mult:
-            bvar += dt*p_ex*l*dx
-        # incorporate Neumann boundary conditions into right hand side
-        for tag, bc in nbcs.items():
-            bvar += dt*bc*v*ds(tag)
-
-        # solve the linear system
-        if linsolver in ["petsc", "lu", "gmres"]:
-            solve(Avar == bvar, w, dbc, solver_parameters = {"linear_solver": linsolver})
-        elif linsolver=="krypy":
-            A, b = assemble_system(Avar, bvar, dbc,
-                  #exterior_facet_domains = boundaries
-                  )
-
-            # use initial guess that satisfies boundary conditions
-            #w0.vector().zero()
-            for bc in dbc:
-                bc.apply(w0.vector())
-            x0 = w0.vector().array().reshape((w0.vector().size(),1))
-
-            A = get_csr_matrix(A)
-            b = b.data().reshape((b.size(),1))
-
-            # build preconditioner 
-            # cf. "Fast iterative solvers for discrete Stokes equations", 
-            # Peters, Reichelt, Reusken 2005
-            if Mprec is None:
-                M, _ = assemble_system(Mvar, bvar, dbc,
-                        exterior_facet_domains=boundaries)
-                M = get_csr_matrix(M)
-                MV = M[Vdofs,:][:,Vdofs]
-                MQ = M[Qdofs,:][:,Qdofs]
-                if lagrange_mult:
-                    ML = M[Ldofs,:][:,Ldofs]
-
-                N, _ = assemble_system(Nvar, bvar, dbc,
-                        exterior_facet_domains=boundaries)
-                N = get_csr_matrix(N)
-                NQ = N[Qdofs,:][:,Qdofs]
-
-#                solver_diagnostics(MV,
-#                       fname='solver_diagnostic_MV',
-#                       definiteness='positive',
-#                       symmetry='hermitian'
-#                       )
-#                solver_diagnostics(MQ,
-#                       fname='solver_diagnostic_MQ',
-#                       definiteness='positive',
-#                       symmetry='hermitian'
-#                       )
-#                solver_diagnostics(NQ,
-#                       fname='solver_diagnostic_NQ',
-#                       definiteness='positive',
-#                       symmetry='hermitian'
-#                       )
-#                return
-
-                # pyamg is non-deterministic atm. fix it by setting the random seed
-                # cf. https://code.google.com/p/pyamg/issues/detail?id=139
-                np.random.seed(1337)
-
-                MVamg = smoothed_aggregation_solver(MV, max_levels=25, max_coarse=50)
-                MQamg = smoothed_aggregation_solver(MQ, max_levels=25, max_coarse=50)
-                NQamg = smoothed_aggregation_solver(NQ, max_levels=25, max_coarse=50)
-                amgtol = 1e-15
-                amgmaxiter = 3
-
-                def Prec_solve(x):
-                    xV = x[Vdofs]
-                    xQ = x[Qdofs]
-                    if lagrange_mult:
-                        xL = x[Ldofs]
-                    ret = np.zeros(x.shape)
-                    ret[Vdofs] = MVamg.solve(xV, maxiter=amgmaxiter, tol=amgtol).reshape(xV.shape)
-                    if hmin**2 <= dt:
-                        ret[Qdofs] =           MQamg.solve(xQ, maxiter=amgmaxiter, tol=amgtol).reshape(xQ.shape) \
-                                   + (1/dt)   *NQamg.solve(xQ, maxiter=amgmaxiter, tol=amgtol).reshape(xQ.shape)
-                    else:
-                        ret[Qdofs] = (hmin**2/dt)*MQamg.solve(xQ, maxiter=amgmaxiter, tol=amgtol).reshape(xQ.shape) \
-                                   + (1/dt)   *NQamg.solve(xQ, maxiter=amgmaxiter, tol=amgtol).reshape(xQ.shape)
-                    if lagrange_mult:
-                        ret[Ldofs] = xL
-                    return ret
-                Prec = LinearOperator(A.shape, Prec_solve)
-
-            # prepare deflation vectors
-            if Z.shape[1] > 0:
-                #Z, _ = np.linalg.qr(Z)
-                AZ = A*Z
-                Proj, x0 = utils.get_projection(b, Z, AZ, x0)
-
-            itsol = linsys.gmres(A, b, x0=x0, tol=1e-6, maxiter=150, Mr=Proj, M=Prec, return_basis = True)
-
-            print("GMRES performed %d iterations with final res %e." % (len(itsol["relresvec"])-1, itsol["relresvec"][-1]) )
-            w.vector().set_local(itsol["xk"])
-
-            # extract deflation data
-            if ('Vfull' in itsol) and ('Hfull' in itsol):
-                if n_defl > 0:
-                    ritz_vals, ritz_coeffs, ritz_res_norm = utils.ritzh(itsol['Vfull'], itsol['Hfull'], Z, AZ, A, M=Prec)
-                    sorti = np.argsort(abs(ritz_vals))
-                    selection = sorti[:n_defl]
-                    nZ = Z.shape[1]
-                    Z = np.dot(Z, ritz_coeffs[0:nZ, selection]) \
-                      + np.dot(itsol['Vfull'][:,0:-1], ritz_coeffs[nZ:,selection])
-                else:
-                    Z = np.zeros( (n_dofs,0) )
+        # Define variational problem
+        if lagrange_mult:
+            (u, p, lam) = TrialFunctions(W)
+            (v, q, l) = TestFunctions(W)
         else:
-            raise RuntimeError("Linear solver '%s' unknown." % linsolver)
-
-        # Get sub-functions
-        w0.assign(w)
+            (u, p) = TrialFunctions(W)
+            (v, q) = TestFunctions(W)
+        ds = Measure('ds')[boundaries]
+    
+        dbc = [DirichletBC(W.sub(0), bc, boundaries, tag) for tag, bc in dbcs.items()]
+        # the system matrix is mass + dt*stiffness
+        mass_var = inner(u,v)*dx
+        stiffness_var = inner(grad(u), grad(v))*dx - div(v)*p*dx - q*div(u)*dx
         if lagrange_mult:
-            u_new, p_new, lam_new = w.split()
+            stiffness_var += lam*q*dx + p*l*dx
+
+        # timings and solver statistics, step 0 is the setup
+        stats = SolveStats(stats_file, append=state is not None)
+        stats.begin_step(0, t)
+        with stats.phase('matrix_assembly'):
+            operator = StokesOperator(mass_var, stiffness_var, dbc)
+
+            # pressure mass and laplace matrices for the preconditioner
+            MQ = get_csr_matrix(assemble(p*q*dx)).tocsr(copy=True)
+            NQ = get_csr_matrix(assemble(inner(grad(p),grad(q))*dx)).tocsr(copy=True)
+        if isinstance(prec_cache, str):
+            prec_cache = AMGCache(prec_cache)
+        if block_layout:
+            prec = BlockPreconditioner(layout.V, layout.Q, layout.L, hmin,
+                                       layout.matrix(MQ), layout.matrix(NQ),
+                                       workers=prec_workers, cache=prec_cache, dtype=prec_dtype)
         else:
-            u_new, p_new = w.split()
-        # degree=... is used in dolfin 1.0, newer versions use degree_rise=... (which is cleaner)
-        if u_file is not None:
-            u_file << u_new, t
-        if p_file is not None:
-            p_file << p_new, t
+            layout = None
+            prec = BlockPreconditioner(Vdofs, Qdofs, Ldofs, hmin, MQ, NQ,
+                                       workers=prec_workers, cache=prec_cache, dtype=prec_dtype)
+        solver = StokesLinearSolver(operator, prec, linsolver, prec_refresh, n_defl,
+                                    layout=layout, stats=stats, predictor=predictor,
+                                    recycling=recycling,
+                                    **linsolver_params)
+        if linsolver in ["krypy", "minres"]:
+            print('Estimated memory of the Krylov solver: %.1f MB.' % (solver.memory_estimate()/2.**20))
+        if initial_deflation:
+            # deflation vectors of a coarser level
+            with stats.phase('prolongation'):
+                Z = np.column_stack([interpolate(z, W).vector().array() for z in initial_deflation])
+            solver.Z = layout.to_blocks(Z) if layout is not None else Z
+
+        if time_integrator is not None:
+            if isinstance(time_integrator, str):
+                time_integrator = getattr(lirk, time_integrator.lower())
+            stepper = get_lirk_stepper(time_integrator, n_dofs)
+
+            # source terms of the right hand side F(t,w) = source(t) - stiffness*w
+            source_var = inner(f, v)*dx
+            if p_ex is not None and lagrange_mult:
+                source_var += p_ex*l*dx
+            for tag, bc in nbcs.items():
+                source_var += bc*v*ds(tag)
+            # the Dirichlet conditions are the algebraic equations g(t) - w_B = 0
+            def source(t):
+                set_time(expressions, t)
+                with stats.phase('rhs_assembly'):
+                    s = assemble(source_var).array()
+                with stats.phase('bcs'):
+                    s[operator.bc_dofs] = get_bc_values(dbc)[1]
+                return s
+            def F(rhs, fac, t, w):
+                Fw = source(t) - operator.apply_stiffness(w)
+                Fw[operator.bc_dofs] -= w[operator.bc_dofs]
+                rhs += fac*Fw
+            # dF/dt only depends on t_n, so the central difference is computed
+            # once per step and reused for all stages
+            dtF_cache = [None, None]
+            def dtF(rhs, fac, t, w):
+                if dtF_cache[0] != t:
+                    delta = 1e-6*max(1., abs(t))
+                    dtF_cache[1] = (source(t+delta) - source(t-delta))/(2*delta)
+                    dtF_cache[0] = t
+                rhs += fac*dtF_cache[1]
+            def Mop(rhs, fac, t, w):
+                rhs += fac*operator.apply_mass(w)
+            # (M/fac2 - J) x = rhs is (mass + fac2*stiffness) x = fac2*rhs with
+            # x_B = rhs_B. Stage i of the last step is the initial guess for stage i.
+            stage_x0 = [None]*time_integrator.num_stages
+            stage_count = [0]
+            def sys(x, fac, t, rhs, fac2):
+                i = stage_count[0] % time_integrator.num_stages
+                stage_count[0] += 1
+                stage_x0[i] = solver.solve(fac2, fac2*rhs, rhs[operator.bc_dofs],
+                                           x0=stage_x0[i], step=n_step)
+                x += fac*stage_x0[i]
+
+            # initial value
+            V_c, Vmap = W.sub(0).collapse(mesh)
+            u_c = interpolate(u_init, V_c)
+            w_vec = np.zeros(n_dofs)
+            w_vec[list(Vmap.values())] = u_c.vector().array()[list(Vmap.keys())]
+            w_vec[operator.bc_dofs] = get_bc_values(dbc)[1]
 
         if u_ex is not None:
-            u_err_norms += [errornorm(u_ex, u_new)]
-            if u_err_file is not None:
-                u_err = Function(V)
-                u_err.interpolate(u_ex)
-                u_new_tmp = Function(V)
-                u_new_tmp.assign(u_new)
-                u_err.vector().axpy(-1.0, u_new_tmp.vector())
-                u_err_file << u_err
+            u_err_norms = []
         if p_ex is not None:
-            p_err_norms += [errornorm(p_ex, p_new)]
-            if p_err_file is not None:
-                p_err = Function(Q)
-                p_err.interpolate(p_ex)
-                p_new_tmp = Function(V)
-                p_new_tmp.assign(p_new)
-                p_err.vector().axpy(-1.0, p_new_tmp.vector())
-                p_err_file << u_err
+            p_err_norms = []
+        n_step = 0
+        history = []
+
+        if state is not None:
+            t = float(state['t'])
+            n_step = int(state['n_step'])
+            u_old.vector().set_local(state['u_old'])
+            w0.vector().set_local(state['w0'])
+            w.vector().set_local(state['w0'])
+            if time_integrator is not None:
+                w_vec = state['w0'].copy()
+            solver.Z = state['Z']
+            if u_ex is not None:
+                u_err_norms = list(state['u_err_norms'])
+            if p_ex is not None:
+                p_err_norms = list(state['p_err_norms'])
+            set_time(expressions, t)
+            # the loop may not run at all if the checkpoint is at tend
+            if lagrange_mult:
+                u_new, p_new, lam_new = w.split()
+            else:
+                u_new, p_new = w.split()
+            print('Restarted from checkpoint at t=%e (step %d).' % (t, n_step))
+        stats.end_step()
+
+        while t<tend:
+            t += dt
+            n_step += 1
+            stats.begin_step(n_step, t)
+
+            if not reuse_operator and n_step > 1:
+                with stats.phase('matrix_assembly'):
+                    operator = StokesOperator(mass_var, stiffness_var, dbc)
+                solver.operator = operator
+
+            if time_integrator is not None:
+                stepper.step(sys, F, dtF, Mop, t-dt, dt, w_vec)
+                set_time(expressions, t)
+                print(t)
+                w.vector().set_local(w_vec)
+            else:
+                set_time(expressions, t)
+                print(t)
+
+                # update right hand side for implicit Euler
+                bvar = inner(u_old,v)*dx + dt*inner(f, v)*dx
+                if p_ex is not None and lagrange_mult:
+                    bvar += dt*p_ex*l*dx
+                # incorporate Neumann boundary conditions into right hand side
+                for tag, bc in nbcs.items():
+                    bvar += dt*bc*v*ds(tag)
+
+                # solve the linear system
+                with stats.phase('rhs_assembly'):
+                    b = assemble(bvar).array()
+                with stats.phase('bcs'):
+                    _, g = get_bc_values(dbc)
+                # only the iterative solvers use an initial guess
+                if initial_guess is not None and linsolver in ["krypy", "minres"]:
+                    with stats.phase('prolongation'):
+                        x0 = prolong(initial_guess, t, W).vector().array()
+                else:
+                    x0 = w0.vector().array()
+                x = solver.solve(dt, b, g, x0=x0, step=n_step, t=t)
+                w.vector().set_local(x)
+
+            # Get sub-functions
+            w0.assign(w)
+            if keep_history:
+                history.append((t, w.copy(deepcopy=True)))
+            if lagrange_mult:
+                u_new, p_new, lam_new = w.split()
+            else:
+                u_new, p_new = w.split()
+            # degree=... is used in dolfin 1.0, newer versions use degree_rise=... (which is cleaner)
+            output = writer.due(n_step, t)
+            if output:
+                with stats.phase('output'):
+                    if u_file is not None or p_file is not None:
+                        # u_new and p_new share the vector of w and cannot be
+                        # copied, the deep copies of the split are on V and Q
+                        w_out = w.split(deepcopy=True)
+                        writer.put(u_file, w_out[0], t, copy=False)
+                        writer.put(p_file, w_out[1], t, copy=False)
+                    if snapshot_store is not None:
+                        w_arr = w.vector().array()
+                        snapshot_store.append(t, u=w_arr[Vdofs_arr], p=w_arr[Qdofs_arr])
+
+            with stats.phase('error_norms'):
+                if u_ex is not None:
+                    u_err_norms += [errornorm(u_ex, u_new)]
+                    if u_err_file is not None and output:
+                        u_err = Function(V)
+                        u_err.interpolate(u_ex)
+                        u_new_tmp = Function(V)
+                        u_new_tmp.assign(u_new)
+                        u_err.vector().axpy(-1.0, u_new_tmp.vector())
+                        writer.put(u_err_file, u_err, t, copy=False)
+                if p_ex is not None:
+                    p_err_norms += [errornorm(p_ex, p_new)]
+                    if p_err_file is not None and output:
+                        p_err = Function(Q)
+                        p_err.interpolate(p_ex)
+                        p_new_tmp = Function(Q)
+                        p_new_tmp.assign(p_new)
+                        p_err.vector().axpy(-1.0, p_new_tmp.vector())
+                        writer.put(p_err_file, p_err, t, copy=False)
+
+            u_old.assign(u_new)
+
+            if checkpoint is not None and checkpoint.due(n_step):
+                state = {
+                        't': t,
+                        'dt': dt,
+                        'n_step': n_step,
+                        'u_old': u_old.vector().array(),
+                        'w0': w0.vector().array(),
+                        'Z': solver.Z,
+                        }
+                if u_ex is not None:
+                    state['u_err_norms'] = u_err_norms
+                if p_ex is not None:
+                    state['p_err_norms'] = p_err_norms
+                with stats.phase('checkpoint'):
+                    checkpoint.save(n_step, state)
+            stats.end_step()
 
-        u_old.assign(u_new)
+        # the run is complete, a later run must not resume from it
+        if checkpoint is not None:
+            checkpoint.clear()
+    finally:
+        # also on errors: stop the worker pool and write the pending output
+        if prec is not None:
+            prec.close()
+        if snapshot_store is not None:
+            snapshot_store.close()
+        if stats is not None:
+            stats.close()
+        if writer is not None:
+            writer.close()
 
     sol = {
             'u': u_new,
             'p': p_new,
+            'stats': stats.steps,
+            'timings': stats.totals(),
           }
+    if keep_history:
+        sol['history'] = history
+        Z = layout.from_blocks(solver.Z) if layout is not None else solver.Z
+        sol['Z'] = []
+        for i in range(Z.shape[1]):
+            z = Function(W)
+            z.vector().set_local(Z[:,i])
+            sol['Z'].append(z)
     if u_ex is not None:
         sol['u_err_norms'] = u_err_norms
     if p_ex is not None:
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import math
+from math import sin, cos
 from lirk import *
 import unittest
 from dolfin import *
@@ -129,6 +130,276 @@ class LIRKTest(unittest.TestCase):
 				# EOCs should be reached up to 5% error
 				self.assertGreater(e,scheme.order*0.95)
 
+	def test_adaptive(self):
+		'Adaptive integration of a scalar test equation should reach the tolerance.'
+
+		t0 = 0
+		tend = 1
+		lmbda = -.5
+		tol = 1e-6
+
+		def sys(v,fac,t,rhs,fac2):
+			v[:] += fac* rhs[:]/(1/fac2-lmbda)
+		def F(v,fac,t,u):
+			v[:] += fac*lmbda*u
+		def dtF(v,fac,t,u):
+			pass
+		def M(v,fac,t,u):
+			v[:] += fac*u[:]
+		def vecsrc(n):
+			l = []
+			for i in range(n):
+				l.append(np.array([0.]))
+			return l
+		def veccpy(u,v):
+			v[:] = u[:]
+		def zero(u):
+			u[:] = 0
+		def axpy(x,a,y):
+			x[:] = x[:] + a*y[:]
+		def norm(v):
+			return abs(v[0])
+
+		# The embedded methods of ROS3P and ROS3PW coincide with the main method
+		# for linear autonomous problems, so only the 4-stage methods are tested.
+		for scheme in (ros34pw2,ros34pw3,rowdaind2):
+			# the error estimate should behave like dt^order
+			errs = []
+			for dt in [1./2**i for i in range(3,6)]:
+				u = np.array([1.])
+				errs.append(norm(scheme.step(sys,F,dtF,M,t0,dt,u,vecsrc,veccpy,zero,axpy)))
+			for e in np.log(np.array(errs[1:])/np.array(errs[:-1]))/np.log(0.5):
+				self.assertGreater(e,scheme.order*0.9)
+
+			controller = PIController(tol,scheme.order,dt_max=.5)
+			u = np.array([1.])
+			times = []
+			scheme.integrate(sys,F,dtF,M,t0,tend,.1,u,vecsrc,veccpy,zero,axpy,norm,controller,
+				callback=lambda t,dt,u: times.append(t))
+			self.assertAlmostEqual(times[-1],tend)
+			self.assertLess(abs(u[0]-math.exp(lmbda*tend)),100*tol)
+			self.assertLess(controller.num_accepted,50)
+
+	def test_no_error_estimate(self):
+		'Adaptive integration should be rejected without a usable error estimate.'
+
+		def vecsrc(n):
+			l = []
+			for i in range(n):
+				l.append(np.array([0.]))
+			return l
+		def veccpy(u,v):
+			v[:] = u[:]
+		def zero(u):
+			u[:] = 0
+		def axpy(x,a,y):
+			x[:] = x[:] + a*y[:]
+		def norm(v):
+			return abs(v[0])
+
+		# LI_EULER has no embedded method, the one of ROS2 coincides with the method
+		for scheme in (li_euler,ros2):
+			controller = PIController(1e-6,scheme.order)
+			u = np.array([1.])
+			self.assertRaises(ValueError,scheme.integrate,None,None,None,None,0,1,.1,u,
+				vecsrc,veccpy,zero,axpy,norm,controller)
+			stepper = LIRKStepper(scheme,vecsrc,veccpy,zero,axpy)
+			self.assertRaises(ValueError,stepper.integrate,None,None,None,None,0,1,.1,u,norm,controller)
+			plan = scheme.compile(1,J=np.array([[-.5]]))
+			self.assertRaises(ValueError,plan.integrate,lambda t,u: -.5*u,0,1,.1,u,controller)
+			self.assertEqual(u[0],1.)
+
+	def test_linear_estimate(self):
+		'Methods whose error estimate vanishes for linear autonomous problems should be detected.'
+
+		import warnings
+		def vecsrc(n):
+			return [np.array([0.]) for i in range(n)]
+		def veccpy(u,v):
+			v[:] = u[:]
+		def zero(u):
+			u[:] = 0
+		def axpy(x,a,y):
+			x[:] = x[:] + a*y[:]
+		def sys(v,fac,t,rhs,fac2):
+			v[:] += fac* rhs[:]/(1/fac2+.5)
+		def F(v,fac,t,u):
+			v[:] -= fac*.5*u
+		def dtF(v,fac,t,u):
+			pass
+		def M(v,fac,t,u):
+			v[:] += fac*u[:]
+
+		for scheme,vanishes in ((ros3p,True),(ros3pw,True),(ros34pw2,False),(ros34pw3,False),(rowdaind2,False)):
+			self.assertEqual(scheme.linear_estimate_vanishes(),vanishes)
+			u = np.array([1.])
+			err = scheme.step(sys,F,dtF,M,0,.1,u,vecsrc,veccpy,zero,axpy)
+			self.assertEqual(abs(err[0]) < 1e-14,vanishes)
+			with warnings.catch_warnings(record=True) as w:
+				warnings.simplefilter('always')
+				scheme.integrate(sys,F,dtF,M,0,.5,.1,u,vecsrc,veccpy,zero,axpy,
+					lambda v: abs(v[0]),PIController(1e-6,scheme.order,dt_max=.5))
+			self.assertEqual(len(w) > 0,vanishes)
+
+	def test_stepper(self):
+		'A stepper should give the same results as LIRK.step without acquiring vectors per step.'
+
+		lmbda = -.5
+
+		def sys(v,fac,t,rhs,fac2):
+			v[:] += fac* rhs[:]/(1/fac2-lmbda)
+		def F(v,fac,t,u):
+			v[:] += fac*lmbda*u
+		def dtF(v,fac,t,u):
+			pass
+		def M(v,fac,t,u):
+			v[:] += fac*u[:]
+		acquired = []
+		def vecsrc(n):
+			acquired.append(n)
+			l = []
+			for i in range(n):
+				l.append(np.array([0.]))
+			return l
+		def veccpy(u,v):
+			v[:] = u[:]
+		def zero(u):
+			u[:] = 0
+		def axpy(x,a,y):
+			x[:] = x[:] + a*y[:]
+
+		for scheme in (li_euler,ros2,ros3p,ros3pw,ros34pw2,ros34pw3,rowdaind2):
+			del acquired[:]
+			stepper = LIRKStepper(scheme,vecsrc,veccpy,zero,axpy)
+			num_vectors = sum(acquired)
+			self.assertEqual(stepper.nbytes,8*num_vectors)
+
+			u = np.array([1.])
+			u_ref = np.array([1.])
+			t = 0
+			dt = .1
+			for n in range(10):
+				err = stepper.step(sys,F,dtF,M,t,dt,u)
+				err_ref = scheme.step(sys,F,dtF,M,t,dt,u_ref,vecsrc,veccpy,zero,axpy)
+				t += dt
+				self.assertEqual(u[0],u_ref[0])
+				if scheme.bhat.any():
+					self.assertEqual(err[0],err_ref[0])
+			self.assertEqual(stepper.nbytes,8*num_vectors)
+
+	def test_stage_plan(self):
+		'A compiled stage plan should reproduce the callback implementation.'
+
+		import scipy.sparse
+		from scipy.sparse.linalg import splu
+
+		# 1d heat equation with source, mass lumped finite differences
+		n = 50
+		h = 1./(n+1)
+		J = scipy.sparse.diags([np.ones(n-1),-2*np.ones(n),np.ones(n-1)],[-1,0,1],format='csc')/h**2
+		x = np.linspace(h,1-h,n)
+		def f(t):
+			return np.sin(np.pi*x)*np.cos(t)
+		def dtf(t):
+			return -np.sin(np.pi*x)*np.sin(t)
+
+		def sys(v,fac,t,rhs,fac2):
+			v[:] += fac*splu(scipy.sparse.identity(n,format='csc')/fac2 - J).solve(rhs)
+		def F(v,fac,t,u):
+			v[:] += fac*(J.dot(u) + f(t))
+		def dtF(v,fac,t,u):
+			v[:] += fac*dtf(t)
+		def M(v,fac,t,u):
+			v[:] += fac*u[:]
+		def vecsrc(k):
+			l = []
+			for i in range(k):
+				l.append(np.zeros(n))
+			return l
+		def veccpy(u,v):
+			v[:] = u[:]
+		def zero(u):
+			u[:] = 0
+		def axpy(x,a,y):
+			x[:] = x[:] + a*y[:]
+
+		for scheme in (li_euler,ros2,ros3p,ros3pw,ros34pw2,ros34pw3,rowdaind2):
+			for Jac in (J,J.toarray()):
+				plan = scheme.compile(n,J=Jac)
+				u = np.sin(2*np.pi*x)
+				u_ref = u.copy()
+				t = 0
+				dt = .01
+				for k in range(5):
+					err = plan.step(lambda t,u: J.dot(u)+f(t),t,dt,u,lambda t,u: dtf(t))
+					err_ref = scheme.step(sys,F,dtF,M,t,dt,u_ref,vecsrc,veccpy,zero,axpy)
+					t += dt
+				self.assertLess(np.max(abs(u-u_ref)),1e-12)
+				if scheme.bhat.any():
+					self.assertLess(np.max(abs(err-err_ref)),1e-12)
+
+		# a given factorization is only valid for its step size
+		scheme = ros3pw
+		dt = .01
+		lu = splu(scipy.sparse.identity(n,format='csc')/(dt*scheme.gamma_diag) - J)
+		self.assertRaises(ValueError,scheme.compile,n,factorization=lu)
+		plan = scheme.compile(n,factorization=lu,dt=dt)
+		plan_ref = scheme.compile(n,J=J)
+		u = np.sin(2*np.pi*x)
+		u_ref = u.copy()
+		plan.step(lambda t,u: J.dot(u)+f(t),0,dt,u,lambda t,u: dtf(t))
+		plan_ref.step(lambda t,u: J.dot(u)+f(t),0,dt,u_ref,lambda t,u: dtf(t))
+		self.assertLess(np.max(abs(u-u_ref)),1e-12)
+		self.assertRaises(ValueError,plan.step,lambda t,u: J.dot(u)+f(t),dt,2*dt,u,lambda t,u: dtf(t))
+
+	def test_ensemble(self):
+		'An ensemble plan should reproduce the integration of each member.'
+
+		N = 20
+		lmbdas = -np.linspace(.1,2,N)
+		dts = 1./2**(3+np.arange(N)%5)
+
+		# scalar test equations with a time dependent source
+		def F_ens(t,u):
+			return lmbdas[:,None]*u + np.sin(t)[:,None]
+		def dtF_ens(t,u):
+			return np.cos(t)[:,None]*np.ones_like(u)
+
+		def vecsrc(n):
+			l = []
+			for i in range(n):
+				l.append(np.array([0.]))
+			return l
+		def veccpy(u,v):
+			v[:] = u[:]
+		def zero(u):
+			u[:] = 0
+		def axpy(x,a,y):
+			x[:] = x[:] + a*y[:]
+
+		for scheme in (li_euler,ros2,ros3p,ros3pw,ros34pw2,ros34pw3,rowdaind2):
+			plan = scheme.compile_ensemble(N,1,lmbdas[:,None,None])
+			u = np.ones((N,1))
+			plan.integrate(F_ens,0.,1.,dts,u,dtF_ens)
+
+			for k in range(N):
+				lmbda = lmbdas[k]
+				def sys(v,fac,t,rhs,fac2):
+					v[:] += fac* rhs[:]/(1/fac2-lmbda)
+				def F(v,fac,t,u):
+					v[:] += fac*(lmbda*u + sin(t))
+				def dtF(v,fac,t,u):
+					v[:] += fac*cos(t)
+				def M(v,fac,t,u):
+					v[:] += fac*u[:]
+				u_ref = np.array([1.])
+				t = 0.
+				while t < 1 - 1e-12:
+					dt = min(dts[k],1-t)
+					scheme.step(sys,F,dtF,M,t,dt,u_ref,vecsrc,veccpy,zero,axpy)
+					t += dt
+				self.assertAlmostEqual(u[k,0],u_ref[0],places=12)
+
 	
 	# Not yet fully implemented:
 	@unittest.expectedFailure
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import snapshots
+from snapshots import *
+
+class SnapshotTest(unittest.TestCase):
+	'Tests for the snapshot store'
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def roundtrip(self, path, backend, compression=False):
+		mesh = {'coordinates': np.random.rand(5,2), 'cells': np.array([[0,1,2],[1,2,3]])}
+		dofmaps = {'u': np.arange(10), 'p': np.arange(10,13)}
+		writer = SnapshotWriter(path, {'u': 10, 'p': 3}, mesh, dofmaps, backend, compression)
+		us = [np.random.rand(10) for k in range(7)]
+		ps = [np.random.rand(3) for k in range(7)]
+		for k in range(7):
+			writer.append(.1*k, u=us[k], p=ps[k])
+		self.assertRaises(ValueError, writer.append, 1., u=us[0])
+		writer.close()
+
+		reader = SnapshotReader(path, backend)
+		self.assertEqual(len(reader), 7)
+		self.assertTrue(np.allclose(reader.times, .1*np.arange(7)))
+		for k in [0, 3, -1]:
+			self.assertTrue(np.array_equal(reader.read('u', k), us[k]))
+			self.assertTrue(np.array_equal(reader.read('p', k), ps[k]))
+		self.assertTrue(np.array_equal(reader.mesh()['cells'], mesh['cells']))
+		self.assertTrue(np.array_equal(reader.dofmaps()['p'], dofmaps['p']))
+		reader.close()
+
+	def test_failed_append(self):
+		'A failed append must not leave the fields misaligned.'
+		path = os.path.join(self.dir, 'snap')
+		writer = SnapshotWriter(path, {'u': 3, 'p': 2}, backend='npy')
+		writer.append(0., u=np.zeros(3), p=np.zeros(2))
+		self.assertRaises(ValueError, writer.append, 1., u=np.ones(3), p=np.ones(3))
+		writer.append(2., u=2*np.ones(3), p=2*np.ones(2))
+		writer.close()
+		reader = SnapshotReader(path)
+		self.assertEqual(len(reader), 2)
+		self.assertTrue(np.array_equal(reader.read('u', 1), 2*np.ones(3)))
+		self.assertTrue(np.array_equal(reader.read('p', 1), 2*np.ones(2)))
+
+	def test_empty(self):
+		path = os.path.join(self.dir, 'snap')
+		SnapshotWriter(path, {'u': 3}, backend='npy').close()
+		reader = SnapshotReader(path)
+		self.assertEqual(len(reader), 0)
+		self.assertEqual(reader.field('u').shape, (0, 3))
+
+	def test_append(self):
+		'A restarted run should continue the store after the time of its checkpoint.'
+		path = os.path.join(self.dir, 'snap')
+		writer = SnapshotWriter(path, {'u': 3}, backend='npy')
+		for k in range(5):
+			writer.append(.1*k, u=k*np.ones(3))
+		writer.close()
+		writer = SnapshotWriter(path, {'u': 3}, backend='npy', append=True)
+		self.assertEqual(writer.count, 5)
+		writer.truncate(.2)
+		for k in range(3, 6):
+			writer.append(.1*k, u=-k*np.ones(3))
+		writer.close()
+		reader = SnapshotReader(path)
+		self.assertEqual(len(reader), 6)
+		self.assertTrue(np.allclose(reader.times, .1*np.arange(6)))
+		self.assertTrue(np.array_equal(reader.read('u', 2), 2*np.ones(3)))
+		self.assertTrue(np.array_equal(reader.read('u', 3), -3*np.ones(3)))
+		self.assertRaises(ValueError, SnapshotWriter, path, {'u': 4}, backend='npy', append=True)
+
+	def test_npy(self):
+		self.roundtrip(os.path.join(self.dir, 'snap'), 'npy')
+
+	@unittest.skipIf(snapshots.h5py is None, 'h5py not available')
+	def test_hdf5(self):
+		self.roundtrip(os.path.join(self.dir, 'snap.h5'), 'hdf5', compression=True)
+
+if __name__ == '__main__':
+	unittest.main()
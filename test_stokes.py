@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+from stokes import *
+from snapshots import SnapshotReader
+
+class LinearAlgebraTest(unittest.TestCase):
+    'Tests for the sparse matrix helpers, the block layout and the caches'
+
+    def random_csr(self, n, m, density=.2, seed=0):
+        return scipy.sparse.rand(n, m, density=density, format='csr',
+                                 random_state=np.random.RandomState(seed))
+
+    def test_csr_submatrix(self):
+        'csr_submatrix should agree with fancy indexing.'
+        A = self.random_csr(30, 20)
+        rng = np.random.RandomState(1)
+        rows = rng.permutation(30)[:12]
+        cols = rng.permutation(20)[:7]
+        B = csr_submatrix(A, rows, cols)
+        self.assertEqual(B.shape, (12, 7))
+        self.assertTrue(np.array_equal(B.toarray(), A.toarray()[rows][:,cols]))
+        self.assertTrue(B.has_sorted_indices)
+
+        B = csr_submatrix(A, slice(5, 25), slice(3, 11))
+        self.assertTrue(np.array_equal(B.toarray(), A.toarray()[5:25,3:11]))
+
+        col_map = -np.ones(20, dtype=intc)
+        col_map[cols] = np.arange(len(cols), dtype=intc)
+        B = csr_submatrix(A, rows, cols, col_map)
+        self.assertTrue(np.array_equal(B.toarray(), A.toarray()[rows][:,cols]))
+
+    def test_block_layout(self):
+        'The block numbering should be a permutation with contiguous blocks.'
+        perm = np.random.RandomState(2).permutation(15)
+        Vdofs, Qdofs, Ldofs = perm[:10], perm[10:14], perm[14:]
+        layout = BlockLayout(Vdofs, Qdofs, Ldofs)
+        x = np.random.rand(15)
+        y = layout.to_blocks(x)
+        self.assertTrue(np.array_equal(y[layout.V], x[Vdofs]))
+        self.assertTrue(np.array_equal(y[layout.Q], x[Qdofs]))
+        self.assertTrue(np.array_equal(y[layout.L], x[Ldofs]))
+        self.assertTrue(np.array_equal(layout.from_blocks(y), x))
+
+        A = self.random_csr(15, 15, density=.3)
+        B = layout.matrix(A)
+        self.assertTrue(np.allclose(B*y, layout.to_blocks(A*x)))
+        self.assertTrue(np.array_equal(B.toarray(), A.toarray()[perm][:,perm]))
+
+        layout = BlockLayout(Vdofs, perm[10:])
+        self.assertIsNone(layout.L)
+        self.assertEqual(layout.Q, slice(10, 15))
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=2)
+        cache[1] = 'a'
+        cache[2] = 'b'
+        cache[1]
+        cache[3] = 'c'
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(1 in cache)
+        self.assertFalse(2 in cache)
+        self.assertEqual(cache[3], 'c')
+
+    def test_krylov_memory(self):
+        self.assertEqual(krylov_memory(1000, 30), 8*(36*1000 + 31*30))
+        self.assertEqual(krylov_memory(1000, 30, 5) - krylov_memory(1000, 30), 8*15*1000)
+        self.assertLess(krylov_memory(1000, 10), krylov_memory(1000, 20))
+
+class PredictorTest(unittest.TestCase):
+    'Tests for the initial guesses of the Predictor'
+
+    def test_extrapolation(self):
+        'Quadratic solution curves should be extrapolated exactly from 3 steps.'
+        a, b, c = np.random.rand(3, 8)
+        x = lambda t: a + b*t + c*t**2
+        pred = Predictor(k=3)
+        for t in [0., .1, .3, .4]:
+            pred.push(t, x(t))
+        self.assertEqual(len(pred), 3)
+        self.assertTrue(np.allclose(pred.predict(.6), x(.6)))
+
+    def test_projection(self):
+        'A solution in the span of the history should be found by the projection.'
+        A = scipy.sparse.csr_matrix(np.eye(8) + .1*np.random.rand(8, 8))
+        X = np.random.rand(8, 3)
+        pred = Predictor(k=3, method="projection")
+        for k in range(3):
+            pred.push(.1*k, X[:,k])
+        x = np.dot(X, [1., -2., .5])
+        self.assertTrue(np.allclose(pred.predict(.3, A, A*x), x))
+
+    def test_method(self):
+        self.assertRaises(ValueError, Predictor, 3, "spline")
+
+class FileTest(unittest.TestCase):
+    'Tests for the AMG cache and the checkpoints'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def levels(self, seed):
+        A = scipy.sparse.rand(20, 20, density=.2, format='csr',
+                              random_state=np.random.RandomState(seed))
+        P = scipy.sparse.rand(20, 5, density=.3, format='csr',
+                              random_state=np.random.RandomState(seed+1))
+        R = P.T.tocsr()
+        return [(A, P, R), ((R*A*P).tocsr(), None, None)]
+
+    def assertLevelsEqual(self, levels, other):
+        self.assertEqual(len(levels), len(other))
+        for mats, other_mats in zip(levels, other):
+            for M, N in zip(mats, other_mats):
+                if M is None:
+                    self.assertIsNone(N)
+                else:
+                    self.assertTrue(np.array_equal(M.toarray(), N.toarray()))
+
+    def test_amg_cache(self):
+        cache = AMGCache(os.path.join(self.dir, 'amg'))
+        levels = self.levels(0)
+        A = levels[0][0]
+        params = {'max_coarse': 10}
+        key = cache.key(A, params)
+        self.assertEqual(key, cache.key(A.copy(), params))
+        self.assertNotEqual(key, cache.key(2*A, params))
+        self.assertNotEqual(key, cache.key(A, {'max_coarse': 20}))
+        self.assertNotEqual(key, cache.key(A, params, seed=1))
+
+        self.assertIsNone(cache.load(key))
+        cache.store(key, levels)
+        self.assertLevelsEqual(levels, cache.load(key))
+
+    def test_amg_cache_evict(self):
+        'The least recently used entries should be removed if the cache is full.'
+        cache = AMGCache(self.dir)
+        cache.store('old', self.levels(0))
+        os.utime(cache.filename('old'), (0, 0))
+        cache.store('used', self.levels(2))
+        os.utime(cache.filename('used'), (0, 0))
+        cache.load('used')
+        cache.max_bytes = os.path.getsize(cache.filename('used')) + os.path.getsize(cache.filename('old'))
+        # same size as the old entry, so exactly one entry has to go
+        cache.store('new', self.levels(0))
+        self.assertIsNone(cache.load('old'))
+        self.assertIsNotNone(cache.load('used'))
+        self.assertLevelsEqual(self.levels(0), cache.load('new'))
+
+    def test_checkpointer(self):
+        checkpoint = Checkpointer(os.path.join(self.dir, 'checkpoints'), every=2, keep=2)
+        self.assertIsNone(checkpoint.latest())
+        self.assertTrue(checkpoint.due(4))
+        self.assertFalse(checkpoint.due(5))
+        for step in [2, 4, 6]:
+            checkpoint.save(step, {'step': step, 't': .1*step, 'x': step*np.arange(5.)})
+        self.assertEqual(len(checkpoint.files()), 2)
+        state = checkpoint.latest()
+        self.assertEqual(int(state['step']), 6)
+        self.assertAlmostEqual(float(state['t']), .6)
+        self.assertTrue(np.array_equal(state['x'], 6*np.arange(5.)))
+        self.assertEqual([name for name in os.listdir(checkpoint.directory)
+                          if name.endswith('.tmp')], [])
+        checkpoint.clear()
+        self.assertIsNone(checkpoint.latest())
+
+class StokesOperatorTest(unittest.TestCase):
+    'Tests for the assembled system matrices of the Stokes problem'
+
+    def setUp(self):
+        set_log_active(False)
+        mesh = UnitSquareMesh(4, 4)
+        V = VectorFunctionSpace(mesh, "CG", 2)
+        Q = FunctionSpace(mesh, "CG", 1)
+        W = MixedFunctionSpace([V, Q])
+        (u, p) = TrialFunctions(W)
+        (v, q) = TestFunctions(W)
+        self.mass_var = inner(u,v)*dx
+        self.stiffness_var = inner(grad(u), grad(v))*dx - div(v)*p*dx - q*div(u)*dx
+        self.dbc = [DirichletBC(W.sub(0), Expression(("x[1]", "0.0")), "on_boundary")]
+        self.operator = StokesOperator(self.mass_var, self.stiffness_var, self.dbc)
+        self.M = get_csr_matrix(assemble(self.mass_var)).tocsr(copy=True)
+        self.K = get_csr_matrix(assemble(self.stiffness_var)).tocsr(copy=True)
+
+    def test_elimination(self):
+        'The boundary conditions should be eliminated symmetrically.'
+        fac = .1
+        A = self.operator.system(fac)
+        self.assertIs(A, self.operator.system(fac))
+        self.assertLess(abs(A - A.T).max(), 1e-12)
+
+        bc_dofs = self.operator.bc_dofs
+        inner_dofs = np.setdiff1d(np.arange(A.shape[0]), bc_dofs)
+        full = (self.M + fac*self.K).toarray()
+        Ad = A.toarray()
+        self.assertTrue(np.allclose(Ad[np.ix_(inner_dofs, inner_dofs)],
+                                    full[np.ix_(inner_dofs, inner_dofs)]))
+        self.assertTrue(np.array_equal(Ad[bc_dofs][:,bc_dofs], np.eye(len(bc_dofs))))
+        self.assertEqual(abs(Ad[np.ix_(bc_dofs, inner_dofs)]).max(), 0)
+
+    def test_lifting(self):
+        'The lifted right hand side should match the system with boundary values.'
+        fac = .1
+        bc_dofs, g = get_bc_values(self.dbc)
+        x = np.random.rand(self.M.shape[0])
+        x[bc_dofs] = g
+        b = (self.M + fac*self.K)*x
+        self.operator.apply_bcs(b, fac, g)
+        self.assertTrue(np.allclose(b, self.operator.system(fac)*x))
+        # the current values of the boundary conditions are the default
+        b = (self.M + fac*self.K)*x
+        self.operator.apply_bcs(b, fac)
+        self.assertTrue(np.allclose(b, self.operator.system(fac)*x))
+
+        inner_dofs = np.setdiff1d(np.arange(len(x)), bc_dofs)
+        Mx = self.operator.apply_mass(x)
+        self.assertTrue(np.allclose(Mx[inner_dofs], (self.M*x)[inner_dofs]))
+        self.assertEqual(abs(Mx[bc_dofs]).max(), 0)
+        Kx = self.operator.apply_stiffness(x)
+        self.assertTrue(np.allclose(Kx[inner_dofs], (self.K*x)[inner_dofs]))
+
+    def test_matrix(self):
+        'The dolfin matrix should be the csr system up to the symmetric elimination.'
+        fac = .2
+        A = get_csr_matrix(self.operator.matrix(fac))
+        bc_dofs = self.operator.bc_dofs
+        inner_dofs = np.setdiff1d(np.arange(A.shape[0]), bc_dofs)
+        self.assertTrue(np.allclose(A.toarray()[inner_dofs],
+                                    (self.M + fac*self.K).toarray()[inner_dofs]))
+        # only the last two values of fac are kept
+        self.operator.system(.1)
+        self.operator.system(.2)
+        self.operator.system(.3)
+        self.assertEqual(len(self.operator._systems), 2)
+        self.assertFalse(.1 in self.operator._systems)
+
+class PrecRefreshPolicyTest(unittest.TestCase):
+    'Tests for the rebuild decisions of the PrecRefreshPolicy'
+
+    class FakePrec(object):
+        def __init__(self):
+            self.is_setup = False
+            self.dt = None
+            self.setup_step = None
+            self.setup_matrix = None
+        def setup(self, A, dt, step):
+            self.is_setup = True
+            self.dt = dt
+            self.setup_step = step
+            self.setup_matrix = A
+
+    def setups(self, policy, steps):
+        'steps is a list of (A, dt, iterations of the last solve), returns the setup steps'
+        prec = self.FakePrec()
+        setups = []
+        for step, (A, dt, iterations) in enumerate(steps):
+            if policy.needs_refresh(prec, step, dt, iterations, A):
+                prec.setup(A, dt, step)
+                setups.append(step)
+        return setups
+
+    def test_default(self):
+        'By default the preconditioner is built once per dt.'
+        A, B = object(), object()
+        steps = [(A, .1, None), (A, .1, 20), (A, .1, 20), (B, .05, 20), (B, .05, 25)]
+        self.assertEqual(self.setups(PrecRefreshPolicy(), steps), [0, 3])
+
+    def test_every(self):
+        'A rebuild for the same matrix and dt is skipped.'
+        A, B = object(), object()
+        steps = [(A, .1, None), (A, .1, 20), (A, .1, 20), (B, .1, 20), (B, .1, 20)]
+        self.assertEqual(self.setups(PrecRefreshPolicy(every=2), steps), [0, 3])
+        steps = [(A, .1, None), (A, .1, 20), (A, .1, 20), (A, .1, 20)]
+        self.assertEqual(self.setups(PrecRefreshPolicy(every=1), steps), [0])
+
+    def test_iterations(self):
+        'The iterations are compared with the first solve after the setup.'
+        steps = [(object(), .1, None), (object(), .1, 40), (object(), .1, 44),
+                 (object(), .1, 46), (object(), .1, 30), (object(), .1, 34)]
+        policy = PrecRefreshPolicy(max_iterations=5)
+        self.assertEqual(self.setups(policy, steps), [0, 3])
+
+class RecyclingStrategyTest(unittest.TestCase):
+    'Tests for the deflation vectors and the auto-disable decision'
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.N = 80
+        # three small eigenvalues, the rest in [1, 3]
+        eigs = np.concatenate([[1e-3, 1e-2, 3e-2], np.linspace(1, 3, self.N-3)])
+        self.A = np.diag(eigs) + .01*rng.randn(self.N, self.N)
+        self.M = np.diag(1/np.linspace(1, 2, self.N))
+        self.rng = rng
+
+    def arnoldi(self, B, n):
+        'Arnoldi relation B*V = Vfull*Hfull with n steps'
+        Vfull = np.zeros((self.N, n+1))
+        H = np.zeros((n+1, n))
+        v = self.rng.randn(self.N)
+        Vfull[:,0] = v/np.linalg.norm(v)
+        for k in range(n):
+            w = np.dot(B, Vfull[:,k])
+            for i in range(k+1):
+                H[i,k] = np.dot(Vfull[:,i], w)
+                w -= H[i,k]*Vfull[:,i]
+            H[k+1,k] = np.linalg.norm(w)
+            Vfull[:,k+1] = w/H[k+1,k]
+        return {'Vfull': Vfull, 'Hfull': H}
+
+    def assertSubspace(self, Z, Y, tol):
+        'span Y should be contained in span Z'
+        Z = np.linalg.qr(Z)[0]
+        Y = np.linalg.qr(Y)[0]
+        self.assertLess(np.linalg.norm(Y - np.dot(Z, np.dot(Z.T, Y))), tol)
+
+    def test_harmonic(self):
+        'The harmonic Ritz vectors from the Arnoldi relation should match the explicit ones.'
+        from scipy.sparse.linalg import aslinearoperator
+        A, M = self.A, self.M
+        Z = np.linalg.qr(self.rng.randn(self.N, 2))[0]
+        AZ = np.dot(A, Z)
+        P = np.eye(self.N) - np.dot(Z, np.linalg.solve(np.dot(Z.T, AZ), AZ.T))
+        itsol = self.arnoldi(np.dot(M, np.dot(A, P)), 25)
+        strategy = RecyclingStrategy(2, which="harmonic")
+        Znew = strategy.update(itsol, Z, AZ, aslinearoperator(A), aslinearoperator(M), 1,
+                               aslinearoperator(P))
+        self.assertEqual(Znew.shape, (self.N, 2))
+
+        S = np.column_stack([Z, itsol['Vfull'][:,:-1]])
+        MAS = np.dot(M, np.dot(A, S))
+        theta, Y = scipy.linalg.eig(np.dot(MAS.T, MAS), np.dot(MAS.T, S))
+        selection = np.argsort(abs(theta))[:2]
+        self.assertSubspace(Znew, np.dot(S, np.real(Y[:,selection])), 1e-8)
+
+        # without deflation vectors
+        itsol = self.arnoldi(np.dot(M, A), 25)
+        Znew = strategy.update(itsol, np.zeros((self.N, 0)), np.zeros((self.N, 0)),
+                               aslinearoperator(A), aslinearoperator(M), 2)
+        self.assertEqual(Znew.shape, (self.N, 2))
+
+    def test_selection(self):
+        'Both selections should find the eigenvectors of the smallest eigenvalues.'
+        A = scipy.sparse.diags([np.concatenate([[1e-3, 1e-2], np.linspace(1, 2, 98)])], [0],
+                               format='csr')
+        b = np.ones((100, 1))
+        itsol = linsys.gmres(A, b, tol=1e-12, maxiter=40, return_basis=True)
+        for which in ["ritz", "harmonic"]:
+            Z = RecyclingStrategy(2, which=which).update(
+                    itsol, np.zeros((100, 0)), np.zeros((100, 0)), A, None, 1)
+            self.assertSubspace(Z, np.eye(100)[:,:2], 1e-3)
+        self.assertRaises(ValueError, RecyclingStrategy, 2, "spectral")
+
+    def solves(self, strategy, overhead, n=8):
+        'n solves with 30 iterations without and 25 with deflation, 1ms per iteration'
+        probes = []
+        for k in range(n):
+            # the first solve has no deflation vectors yet
+            deflated = strategy.use_deflation() and k > 0
+            probes.append(strategy.probe)
+            if strategy.probe:
+                self.assertFalse(strategy.wants_update(k))
+            its = 25 if deflated else 30
+            strategy.record(its, its*1e-3, overhead if deflated else 0., deflated)
+        return probes
+
+    def test_auto_disable(self):
+        'Deflation should be switched off if its overhead exceeds the savings.'
+        strategy = RecyclingStrategy(2, samples=2, probe_every=3)
+        probes = self.solves(strategy, overhead=.01)
+        self.assertEqual(probes[:5], [False, True, False, True, False])
+        self.assertFalse(strategy.enabled)
+        self.assertFalse(strategy.use_deflation())
+
+        strategy = RecyclingStrategy(2, samples=2, probe_every=3)
+        self.solves(strategy, overhead=.001)
+        self.assertTrue(strategy.enabled)
+
+        strategy = RecyclingStrategy(2, samples=2, auto_disable=False)
+        probes = self.solves(strategy, overhead=.01)
+        self.assertFalse(any(probes))
+        self.assertTrue(strategy.enabled)
+
+class SolveStatsTest(unittest.TestCase):
+    'Tests for the per step timings and solver statistics'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_steps(self):
+        stats = SolveStats()
+        with stats.phase('setup'):
+            pass
+        stats.record_solve(10)
+        self.assertEqual(stats.steps, [])
+        for step in [1, 2]:
+            stats.begin_step(step, .1*step)
+            for k in range(2):
+                with stats.phase('gmres'):
+                    pass
+                stats.record_solve(step+k, [1., .1])
+            with stats.phase('output'):
+                pass
+            stats.end_step()
+        self.assertEqual([record['step'] for record in stats.steps], [1, 2])
+        self.assertEqual(stats.steps[1]['iterations'], [2, 3])
+        self.assertEqual(stats.steps[0]['residuals'], [[1., .1], [1., .1]])
+        self.assertEqual(sorted(stats.totals()), ['gmres', 'output'])
+        self.assertAlmostEqual(stats.totals()['gmres'],
+                               sum(record['times']['gmres'] for record in stats.steps))
+
+    def test_phase_error(self):
+        'The time of a phase should be recorded if it raises.'
+        stats = SolveStats()
+        stats.begin_step(1, .1)
+        try:
+            with stats.phase('assembly'):
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        stats.end_step()
+        self.assertTrue('assembly' in stats.steps[0]['times'])
+
+    def test_stream(self):
+        'The steps should be streamed as JSON lines, appended on restart.'
+        fname = os.path.join(self.dir, 'stats.json')
+        for append, steps in [(False, [1, 2]), (True, [3])]:
+            stats = SolveStats(fname, append=append)
+            for step in steps:
+                stats.begin_step(step, .1*step)
+                stats.record_solve(None)
+                stats.end_step()
+            stats.close()
+        with open(fname) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record['step'] for record in records], [1, 2, 3])
+        self.assertEqual(records[0]['iterations'], [None])
+
+class AsyncWriterTest(unittest.TestCase):
+    'Tests for the background writer of the time series'
+
+    class FakeFile(object):
+        def __init__(self, fail=False):
+            self.written = []
+            self.fail = fail
+        def __lshift__(self, item):
+            if self.fail:
+                raise IOError('disk full')
+            self.written.append(item)
+            return self
+
+    class FakeFunction(object):
+        def __init__(self, value):
+            self.value = value
+        def copy(self, deepcopy=False):
+            return AsyncWriterTest.FakeFunction(self.value)
+
+    def test_due(self):
+        writer = AsyncWriter(every=2)
+        self.assertEqual([writer.due(k, .1*k) for k in range(1, 5)], [False, True, False, True])
+        writer.close()
+        writer = AsyncWriter(every=1, every_t=.25)
+        self.assertEqual([writer.due(k, .1*k) for k in range(0, 7)],
+                         [True, False, False, True, False, False, True])
+        writer.close()
+
+    def test_put(self):
+        'Enqueued functions should be copies written in order.'
+        f = self.FakeFile()
+        writer = AsyncWriter(maxsize=2)
+        func = self.FakeFunction(0)
+        for k in range(5):
+            func.value = k
+            writer.put(f, func, .1*k)
+        writer.put(None, func)
+        writer.close()
+        self.assertEqual([(item[0].value, item[1]) for item in f.written],
+                         [(k, .1*k) for k in range(5)])
+        self.assertTrue(all(item[0] is not func for item in f.written))
+
+    def test_error(self):
+        'Errors of the writer thread should be raised in the solver thread.'
+        writer = AsyncWriter()
+        writer.put(self.FakeFile(fail=True), self.FakeFunction(0), 0.)
+        self.assertRaises(IOError, writer.close)
+        self.assertRaises(IOError, writer.put, self.FakeFile(), self.FakeFunction(1), 1.)
+
+class SolveStokesTest(unittest.TestCase):
+    'Tests for the time loop of solve_stokes'
+
+    def setUp(self):
+        set_log_active(False)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_output(self):
+        'A few steps with File outputs and a snapshot store should write every step.'
+        mesh, problem = eoc2d_problem(2)
+        dt = .1*mesh.hmax()
+        sol = solve_stokes(mesh, scale_dt=.1, tend=3*dt*(1-1e-10), linsolver='lu',
+                           u_file=File(os.path.join(self.dir, 'velocity.pvd')),
+                           p_file=File(os.path.join(self.dir, 'pressure.pvd')),
+                           snapshots=os.path.join(self.dir, 'snapshots'),
+                           **problem)
+        self.assertEqual(len(sol['stats']), 4)
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'velocity.pvd')))
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'pressure.pvd')))
+        reader = SnapshotReader(os.path.join(self.dir, 'snapshots'))
+        self.assertTrue(np.allclose(reader.times, dt*np.arange(1, 4)))
+        reader.close()
+
+    def final_velocity(self, scale_dt, tend, **kwargs):
+        'velocity dofs at tend of eoc2d_problem(2)'
+        mesh, problem = eoc2d_problem(2)
+        problem.update(kwargs)
+        sol = solve_stokes(mesh, scale_dt=scale_dt, tend=tend, linsolver='lu',
+                           keep_history=True, **problem)
+        return sol['history'][-1][1].split(deepcopy=True)[0].vector().array()
+
+    def test_time_integrator(self):
+        'A Rosenbrock method should agree with implicit Euler up to the O(dt) error of Euler.'
+        mesh, _ = eoc2d_problem(2)
+        scale_dt = .1
+        # both step sizes end exactly at tend
+        tend = 4*scale_dt*mesh.hmax()*(1-1e-10)
+        u_euler = []
+        u_ros = []
+        for k in range(2):
+            u_euler.append(self.final_velocity(scale_dt/2**k, tend))
+            u_ros.append(self.final_velocity(scale_dt/2**k, tend, time_integrator='ros34pw2'))
+        diffs = [np.linalg.norm(ue - ur) for ue, ur in zip(u_euler, u_ros)]
+        self.assertLess(diffs[1], .6*diffs[0])
+        self.assertLess(np.linalg.norm(u_ros[1] - u_ros[0]), np.linalg.norm(u_euler[1] - u_euler[0]))
+
+if __name__ == '__main__':
+    unittest.main()